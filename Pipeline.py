@@ -20,11 +20,14 @@ import nipype.pipeline.engine as pe         # pypeline engine
 import numpy as np
 import os, sys
 import time
+import dataset_index as di
+import atlas_sidecar as asc
 
 
 DATATYPE_SUBJECT_DIR = 'func'
 DATATYPE_FILE_SUFFIX = 'bold' 
 SAVE_INTERMEDIATES = True
+DEFAULT_DTYPE = 'float32' # floating point type used by the python nodes to load and save images
 scheduleTXT   = '/app/Template/sched.txt'
 
 
@@ -53,6 +56,30 @@ def makeParser():
                         help='Saves all intermediate files while pipeline is running.')
     parser.add_argument('--testmode', required=False, action='store_true',
                         help='Activates TEST_MODE to make pipeline finish faster for quicker debugging')
+    parser.add_argument('--dynamicWindow', nargs=1, required=False,
+                        help='Window length (in frames) for sliding window similarity matrices. Dynamic connectivity is only computed when this is given.')
+    parser.add_argument('--dynamicStep', nargs=1, required=False,
+                        help='Number of frames the window moves between two dynamic similarity matrices. Default is 1.')
+    parser.add_argument('--dynamicTaper', nargs=1, required=False, choices=['rectangular', 'hann', 'hamming'],
+                        help='Taper applied to each window. Default is rectangular.')
+    parser.add_argument('--sparseThreshold', nargs=1, required=False,
+                        help='Keeps only edges with an absolute similarity above this value and writes them as a sparse matrix. Enables the blocked/sparse similarity computation.')
+    parser.add_argument('--sparseTopK', nargs=1, required=False,
+                        help='Keeps only the K strongest edges of every node and writes them as a sparse matrix. Enables the blocked/sparse similarity computation.')
+    parser.add_argument('--blockSize', nargs=1, required=False,
+                        help='Number of nodes per tile for the blocked/sparse similarity computation. Default is 1024.')
+    parser.add_argument('--voxelwise', required=False, action='store_true',
+                        help='Uses every brain voxel instead of every ROI as a node of the sparse similarity matrix.')
+    parser.add_argument('--seedMaps', required=False, action='store_true',
+                        help='Writes a seed to voxel correlation map for every ROI of the atlas (one 4D NIFTI, one volume per ROI).')
+    parser.add_argument('--dtype', nargs=1, required=False, choices=['float32', 'float64'],
+                        help='Floating point type used to load and save images in the python steps. Default is float32, which halves memory and file sizes compared to float64.')
+    parser.add_argument('--index', nargs=1, required=False,
+                        help='Path to the dataset index used to find runs and their header information. Default is {} next to the subject folders of the out directory.'.format(di.INDEX_FILE_NAME))
+    parser.add_argument('--noIndex', required=False, action='store_true',
+                        help='Lists directories and reads headers directly instead of using the dataset index.')
+    parser.add_argument('-n','--nprocs', nargs=1, required=False,
+                        help='Number of processes used to run independent runs/sessions in parallel. Default is 1 (serial execution).')
 
     return parser 
 
@@ -85,14 +112,77 @@ def makeOutDir(outDirName, args, enforceBIDS=True):
     return outDir
 
 
+# Note: finds every BOLD run of a subject. Sessions are looked up both in the
+#       layout used so far (parentDir/ses-X/sub-Y/func) and in the standard BIDS
+#       layout (parentDir/sub-Y/ses-X/func). If no session is given, all sessions are used.
+#       The dataset is walked by dataset_index.findFuncDirs, without using an index here.
+#       Returns (path, session) pairs; the session is the session folder of the run.
+def findSubjectRuns(parentDir, subjectID, session=None):
+    patient_func_runs = []
+    for subject, run_session, path in di.findRuns(None, parentDir, [subjectID]):
+        if session == None or run_session == session:
+            patient_func_runs.append((path, run_session))
+
+    return patient_func_runs
+
+
+# Note: splits a BIDS filename into the pieces needed to write outputs per run.
+#       The session (if any) becomes the datasink container and the remaining
+#       entities (sub, ses, task, run, ...) are used as a filename prefix.
+#       The session folder of the run wins over the filename, which in the layout
+#       parentDir/ses-X/sub-Y/func often carries no ses- entity; the session is then
+#       added to the prefix so runs of different sessions never share output files.
+def getBIDSEntities(in_file, base_directory='', datatype_dir='func', file_suffix='bold', session=''):
+    import os
+    import re
+
+    basename = os.path.basename(in_file)
+    if basename.endswith('.nii.gz'):
+        basename = basename[:-7]
+    elif basename.endswith('.nii'):
+        basename = basename[:-4]
+    if basename.endswith('_' + file_suffix):
+        basename = basename[:-(len(file_suffix)+1)]
+
+    entities = basename.split('_')
+    file_session = ''
+    for entity in entities:
+        if entity.startswith('ses-'):
+            file_session = entity
+    if session == None or session == '':
+        session = file_session
+    elif file_session == '':
+        # sub-Y_task-rest -> sub-Y_ses-X_task-rest
+        position = 1 if entities[0].startswith('sub-') else 0
+        entities.insert(position, session)
+        basename = '_'.join(entities)
+
+    prefix = basename
+    run_out_dir = os.path.join(base_directory, session, datatype_dir)
+    # outputs of a run are written to [ses-X/]func/<prefix>_<output>; files already carrying the prefix are left alone
+    substitutions = [(r'/{}/(?!{})([^/]+)$'.format(datatype_dir, re.escape(prefix)), r'/{}/{}_\1'.format(datatype_dir, prefix))]
+
+    return session, prefix, substitutions, run_out_dir
+
+
 # Note: collects the TR value from the image and calculates the sigma value for bandpass filtering
-def calculate_sigma(image_path, hp_frequency=0.009, lp_frequency=0.08):
+#       The TR is taken from the dataset index if the image is indexed and unchanged.
+def calculate_sigma(image_path, hp_frequency=0.009, lp_frequency=0.08, index_path=None):
     import nibabel as nib
-    func_img = nib.load(image_path)
-    header = func_img.header
-    test_tuple=header.get_zooms()
-    sigma_val_hp = 1 / ((test_tuple[-1]) * hp_frequency)
-    sigma_val_lp = 1 / ((test_tuple[-1]) * lp_frequency)
+    import sys
+    sys.path.append('/data/')
+    import dataset_index as di
+
+    indexed = di.lookupHeader(index_path, image_path)
+    if indexed != None:
+        tr = indexed[1]
+    else:
+        func_img = nib.load(image_path)
+        header = func_img.header
+        test_tuple=header.get_zooms()
+        tr = test_tuple[-1]
+    sigma_val_hp = 1 / (tr * hp_frequency)
+    sigma_val_lp = 1 / (tr * lp_frequency)
     return sigma_val_hp, sigma_val_lp
 
 
@@ -100,14 +190,23 @@ def calculate_sigma(image_path, hp_frequency=0.009, lp_frequency=0.08):
 def getMaxROI(atlas_path):
     import nibabel as nib
     import numpy as np
-    
+    import sys
+    sys.path.append('/data/')
+    import atlas_sidecar as asc
+
+    # the precomputed sidecar spares loading the atlas
+    sidecar = asc.loadSidecar(atlas_path)
+    if sidecar != None:
+        return sidecar['MaxLabel']
+
+    # the atlas is read with its on-disk (integer) type instead of being converted to float64
     img = nib.load(atlas_path)
-    data = img.get_fdata()
-    return round(np.max(data))
+    data = np.asanyarray(img.dataobj)
+    return int(round(np.max(data)))
 
 
 # Note: This function helps to determine the best volume to use as a reference for motion correction.
-def findBestReference(in_file, scheduleTXT, derivatives_dir):
+def findBestReference(in_file, scheduleTXT, derivatives_dir, file_prefix='', index_path=None):
     import nibabel as nib
     import numpy as np
     from tqdm import tqdm
@@ -115,9 +214,12 @@ def findBestReference(in_file, scheduleTXT, derivatives_dir):
     import json
     sys.path.append('/data/')
     import pipeline_functions as pf
+    import dataset_index as di
 
     entryname = os.path.basename(in_file)
     file_name = "best_frames.json"
+    if file_prefix != '':
+        file_name = '{}_{}'.format(file_prefix, file_name)
     # Check if the file exists in the directory
     bestFramesfile_path = os.path.join(derivatives_dir, file_name)
     if os.path.exists(bestFramesfile_path):
@@ -139,8 +241,12 @@ def findBestReference(in_file, scheduleTXT, derivatives_dir):
         print("File created.")
         data_dict = {}
 
-    img = nib.load(in_file)
-    numFrames = img.get_fdata().shape[-1]
+    indexed = di.lookupHeader(index_path, in_file)
+    if indexed != None:
+        numFrames = indexed[0][-1]
+    else:
+        img = nib.load(in_file)
+        numFrames = img.shape[-1] # header only, the voxels are not needed here
     matrix = np.zeros((numFrames,numFrames))
 
     roi_basename = os.path.basename(in_file)[:-7] + '_vi'
@@ -180,22 +286,19 @@ def findBestReference(in_file, scheduleTXT, derivatives_dir):
 
 # Note: This function is used normalize the median of the data to 1000
 #       Power et al normalized their mode to 1000, but we believe median is more stable.
-def median_1000_normalization(in_file, mask_file=None):
+def median_1000_normalization(in_file, mask_file=None, dtype='float32'):
     import numpy as np
     import nibabel as nib
 
     # Load the NIfTI image data
     img = nib.load(in_file)
-    data = img.get_fdata()
+    data = img.get_fdata(dtype=dtype)
 
     # only find the mode where there is brain tissue
     if not mask_file == None:
         print('Brain mask was provided.')
-        mask_data = nib.load(mask_file).get_fdata()
-        mask_4d   = mask_data[:, :, :, np.newaxis]
-        numFrames = data.shape[-1]
-        mask_4d   = np.tile(mask_4d, (1,1,1,numFrames))
-        datamaskd = data[mask_4d == 1]
+        mask_data = np.asanyarray(nib.load(mask_file).dataobj)
+        datamaskd = data[mask_data == 1]
         median_value = np.median(datamaskd)
     else:
         median_value = np.median(data)
@@ -205,8 +308,9 @@ def median_1000_normalization(in_file, mask_file=None):
     # Perform mode 1000 normalization
     normalized_data = (data / median_value) * 1000
 
-    # Create a new NIfTI image with the normalized data
+    # Create a new NIfTI image with the normalized data, saved with the pipeline's dtype
     normalized_img = nib.Nifti1Image(normalized_data, img.affine, img.header)
+    normalized_img.set_data_dtype(dtype)
 
     output_path = '{}_normalized.nii.gz'.format(in_file[:-7])
     # Save the normalized NIfTI image to the specified output path
@@ -217,7 +321,7 @@ def median_1000_normalization(in_file, mask_file=None):
 
 # Note: This function is used to calculate the DVARS values across the scan
 # MOtion_DVARS_Subprocess
-def MO_DVARS_Subprocess(in_file, mask=None):
+def MO_DVARS_Subprocess(in_file, mask=None, dtype='float32'):
     import os, sys
     import numpy as np
     import nibabel as nib
@@ -227,14 +331,12 @@ def MO_DVARS_Subprocess(in_file, mask=None):
 
     # Load the NIfTI file
     img = nib.load(in_file)
-    data = img.get_fdata()
+    data = img.get_fdata(dtype=dtype)
 
     # Broadcast the mask to all frames
     if not mask == None:
-        mask_data = nib.load(mask).get_fdata()
+        mask_data = np.asanyarray(nib.load(mask).dataobj).astype(dtype)
         mask_4d   = mask_data[:, :, :, np.newaxis]
-        numFrames = data.shape[-1]
-        mask_4d   = np.tile(mask_4d, (1,1,1,numFrames))
         data      = np.multiply(data, mask_4d)
 
     # Calculate the temporal derivative of each voxel
@@ -365,23 +467,30 @@ def ArtifactExtraction(split_images, dvars_outliers, fd_outliers):
 
 # Note: takes in the image paths for the BOLD and template and runs the three 
 # functions to output the average array, similarity matrix and mapping dictionary
-def CalcSimMatrix (bold_path, template_path, maxSegVal): 
+# atlas_path is the atlas in template space, used to name the ROIs
+# Note: with dense=False (sparse mode) only the average array is written; the
+# similarity matrix then comes from CalcSparseSimMatrix and the dense S x S matrix
+# is never built.
+def CalcSimMatrix (bold_path, template_path, maxSegVal, dtype='float32', atlas_path=None, dense=True): 
     import os
     import sys 
     import numpy as np
     import json
     sys.path.append('/data/')
     import pipeline_functions as pf
+    import atlas_sidecar as asc
     
     
     #runs the data extraction functions
-    avg_arr = pf.make_average_arr(bold_path,template_path, maxSegVal)
-    sim_matrix = pf.build_sim_arr(avg_arr)
+    avg_arr = pf.make_average_arr(bold_path,template_path, maxSegVal, dtype)
     
     #saves the extracted data files
-    sim_matrix_file = os.path.join(os.getcwd(),'sim_matrix.csv')
+    sim_matrix_file = None
+    if dense:
+        sim_matrix = pf.build_sim_arr(avg_arr)
+        sim_matrix_file = os.path.join(os.getcwd(),'sim_matrix.csv')
+        np.savetxt(sim_matrix_file, sim_matrix, delimiter=",")
     avg_matrix_file = os.path.join(os.getcwd(),'average_arr.csv')
-    np.savetxt(sim_matrix_file, sim_matrix, delimiter=",")
     np.savetxt(avg_matrix_file, avg_arr, delimiter=",")
     
     # Note: this is not necessary and is only currently being written for backwards compatibility with later analyses
@@ -390,9 +499,102 @@ def CalcSimMatrix (bold_path, template_path, maxSegVal):
     mapping_dict_file = os.path.join(os.getcwd(),'mapping_dict.json')
     with open(mapping_dict_file, 'w') as fp:
         json.dump(mapping_dict, fp, indent = 4)
+
+    # names the columns of the average array (and rows/columns of the similarity matrix)
+    roi_labels_file = asc.writeROILabels(atlas_path, avg_arr.shape[1], os.path.join(os.getcwd(),'roi_labels.tsv'))
     
     #returns the files
-    return avg_matrix_file, sim_matrix_file, mapping_dict_file
+    return avg_matrix_file, sim_matrix_file, mapping_dict_file, roi_labels_file
+
+# Note: sparse version of CalcSimMatrix for fine parcellations or voxelwise graphs.
+# The similarity matrix is computed tile by tile and only edges passing the
+# threshold/top k are kept. Nodes are either the ROIs of the average array or
+# (voxelwise) every voxel inside the brain mask.
+def CalcSparseSimMatrix(avg_arr_file, bold_path, mask_path, voxelwise, block_size, threshold, top_k, dtype='float32', atlas_path=None):
+    import os
+    import sys
+    import numpy as np
+    sys.path.append('/data/')
+    import pipeline_functions as pf
+    import atlas_sidecar as asc
+
+    nodes_file = os.path.join(os.getcwd(), 'sparse_sim_matrix_nodes.csv')
+    if voxelwise:
+        ts_arr, voxel_coords = pf.make_voxel_arr(bold_path, mask_path, dtype)
+        np.savetxt(nodes_file, voxel_coords, fmt='%d', delimiter=",", header='i,j,k', comments='')
+    else:
+        ts_arr = np.loadtxt(avg_arr_file, delimiter=",", ndmin=2)
+        names = asc.roiLabelNames(atlas_path, ts_arr.shape[1])
+        with open(nodes_file, 'w') as f:
+            f.write('roi,name\n')
+            for roi in range(ts_arr.shape[1]):
+                f.write('{},{}\n'.format(roi, names[roi]))
+
+    sparse_matrix_file = os.path.join(os.getcwd(), 'sparse_sim_matrix.npz')
+    numEdges = pf.build_sparse_sim_arr(ts_arr, sparse_matrix_file, block_size, threshold, top_k, dtype)
+    print('Kept {} of {} possible (directed) edges.'.format(numEdges, ts_arr.shape[1] * (ts_arr.shape[1] - 1)))
+
+    return sparse_matrix_file, nodes_file
+
+
+# Note: correlates every ROI of the average array with every voxel of the censored
+# BOLD and writes one 4D NIFTI with one correlation map (volume) per ROI.
+def CalcSeedMaps(avg_arr_file, bold_path, mask_path, dtype='float32', atlas_path=None):
+    import os
+    import sys
+    import numpy as np
+    sys.path.append('/data/')
+    import pipeline_functions as pf
+    import atlas_sidecar as asc
+
+    avg_arr = np.loadtxt(avg_arr_file, delimiter=",", ndmin=2)
+    seed_maps_file = os.path.join(os.getcwd(), 'seed_maps.nii.gz')
+    seeds = pf.build_seed_maps(avg_arr, bold_path, mask_path, seed_maps_file, dtype=dtype)
+
+    # ROI index and name of every volume in the seed maps
+    names = asc.roiLabelNames(atlas_path, avg_arr.shape[1])
+    seed_labels_file = os.path.join(os.getcwd(), 'seed_maps_labels.csv')
+    with open(seed_labels_file, 'w') as f:
+        f.write('roi,name\n')
+        for roi in seeds:
+            f.write('{},{}\n'.format(roi, names[roi]))
+
+    return seed_maps_file, seed_labels_file
+
+
+# Note: sliding window version of CalcSimMatrix. The censored average array is put
+# back on the original timeline (censored frames are left out of every window they
+# fall in) and each window's similarity matrix is streamed to disk.
+def CalcDynamicSimMatrix(avg_arr_file, rejections_file, window_length, step, taper):
+    import os
+    import sys
+    import numpy as np
+    import json
+    sys.path.append('/data/')
+    import pipeline_functions as pf
+
+    avg_arr = np.loadtxt(avg_arr_file, delimiter=",", ndmin=2)
+    with open(rejections_file, 'r') as r:
+        reject_dict = json.load(r)
+    rejected_frames = set(reject_dict['Frames rejected by FD']).union(reject_dict['Frames rejected by DVARS'])
+    full_arr = pf.uncensor_avg_arr(avg_arr, rejected_frames)
+
+    dyn_matrix_file = os.path.join(os.getcwd(), 'dynamic_sim_matrix.npy')
+    starts, numFrames = pf.build_dynamic_sim_arr(full_arr, dyn_matrix_file, window_length, step, taper, censored_frames=rejected_frames)
+
+    # describes how to read the windows back: each row is the upper triangle (k=1) of an SxS matrix
+    dyn_info = {'WindowLength': int(window_length),
+                'Step': int(step),
+                'Taper': taper,
+                'NumberOfROIs': int(full_arr.shape[1]),
+                'Layout': 'rows are windows, columns are the upper triangle (numpy.triu_indices(NumberOfROIs, k=1)) of the similarity matrix',
+                'WindowStarts': starts,
+                'UncensoredFramesPerWindow': numFrames}
+    dyn_info_file = os.path.join(os.getcwd(), 'dynamic_sim_matrix.json')
+    with open(dyn_info_file, 'w') as fp:
+        json.dump(dyn_info, fp, indent = 4)
+
+    return dyn_matrix_file, dyn_info_file
 
 # Note: This function expands the original 6 motion parameters to 24 (R R**2 R' R'**2)
 def expandMotionParameters(par_file):
@@ -499,18 +701,41 @@ def plotMotionMetrics(fd_metrics_file, dvars_metrics_file):
 # PIPELINE CREATION
 # ******************************************************************************
 
-def buildWorkflow(patient_func_path, template_path, segment_path, outDir, subjectID, testmode=False, saveIntermediates=False):
+def buildWorkflow(patient_func_paths, template_path, segment_path, outDir, subjectID, testmode=False, saveIntermediates=False, dynamicWindow=None, dynamicStep=1, dynamicTaper='rectangular', sparseThreshold=None, sparseTopK=None, blockSize=1024, voxelwise=False, seedMaps=False, dtype=DEFAULT_DTYPE, index_path=None, patient_sessions=None):
     #creates a pipeline
     preproc = pe.Workflow(name='preproc')
 
+    if isinstance(patient_func_paths, str):
+        patient_func_paths = [patient_func_paths]
+        if isinstance(patient_sessions, str):
+            patient_sessions = [patient_sessions]
+
     #the input node, which takes the input image from infosource and feeds it into the rest of the pipeline
-    input_node = pe.Node(interface=util.IdentityInterface(fields=['func']),name='input')
-    input_node.inputs.func = patient_func_path
+    #every run/session is an iterable, so everything downstream of this node is repeated per run while
+    #template-side nodes (template/atlas feeds, GetMaxROI) are only executed once and shared
+    #the session folder of every run is iterated in step with the run (synchronize)
+    if patient_sessions == None:
+        patient_sessions = ['' for i in patient_func_paths]
+    input_node = pe.Node(interface=util.IdentityInterface(fields=['func', 'session']),name='input')
+    input_node.iterables = [('func', patient_func_paths), ('session', patient_sessions)]
+    input_node.synchronize = True
+
+
+    #collects the BIDS entities of the current run so outputs are written per run
+    entities_node = pe.Node(interface=util.Function(input_names=['in_file', 'base_directory', 'datatype_dir', 'file_suffix', 'session'], output_names=['session', 'prefix', 'substitutions', 'run_out_dir'], function=getBIDSEntities), name='BIDSEntities')
+    entities_node.inputs.base_directory = outDir
+    entities_node.inputs.datatype_dir = DATATYPE_SUBJECT_DIR
+    entities_node.inputs.file_suffix = DATATYPE_FILE_SUFFIX
+    preproc.connect(input_node, 'func', entities_node, 'in_file')
+    preproc.connect(input_node, 'session', entities_node, 'session')
 
 
     #the datasink node stores the outputs of all operations
+    #outputs land in outDir/[ses-X/]func/ and are prefixed with the run's BIDS entities
     datasink = pe.Node(nio.DataSink(parameterization=False), name='sinker')
     datasink.inputs.base_directory = outDir
+    preproc.connect(entities_node, 'session', datasink, 'container')
+    preproc.connect(entities_node, 'substitutions', datasink, 'regexp_substitutions')
 
 
     reorient2std_node = pe.Node(interface=fsl.Reorient2Std(), name='reorient2std')
@@ -519,10 +744,12 @@ def buildWorkflow(patient_func_path, template_path, segment_path, outDir, subjec
 
 
     #this node accesses the calculate_sigma function to take the input image and output its sigma value
-    sigma_value = pe.Node(interface=util.Function(input_names=['image_path', 'hp_frequency', 'lp_frequency'], output_names=['sigma_value_hp', 'sigma_value_lp'], function=calculate_sigma), name='calculate_sigmas')
+    #reorienting does not change the TR, so the original image is used and its TR can come from the dataset index
+    sigma_value = pe.Node(interface=util.Function(input_names=['image_path', 'hp_frequency', 'lp_frequency', 'index_path'], output_names=['sigma_value_hp', 'sigma_value_lp'], function=calculate_sigma), name='calculate_sigmas')
     sigma_value.inputs.hp_frequency=0.009
     sigma_value.inputs.lp_frequency=0.08
-    preproc.connect(reorient2std_node, 'out_file', sigma_value, 'image_path')
+    sigma_value.inputs.index_path = index_path
+    preproc.connect(input_node, 'func', sigma_value, 'image_path')
 
 
     #the template node feeds a standard brain into the linear registration node to be registered into BOLD space
@@ -535,10 +762,12 @@ def buildWorkflow(patient_func_path, template_path, segment_path, outDir, subjec
     segment_feed.inputs.segment = segment_path
 
     # # finds the best frame to use as a reference
-    bestRef_node = pe.Node(interface=util.Function(input_names=['in_file', 'scheduleTXT', 'derivatives_dir'], output_names=['bestReference', 'bestFramesFile'], function=findBestReference), name='findBestReference')
+    bestRef_node = pe.Node(interface=util.Function(input_names=['in_file', 'scheduleTXT', 'derivatives_dir', 'file_prefix', 'index_path'], output_names=['bestReference', 'bestFramesFile'], function=findBestReference), name='findBestReference')
     bestRef_node.inputs.scheduleTXT = scheduleTXT
-    bestRef_node.inputs.derivatives_dir = os.path.join(datasink.inputs.base_directory, DATATYPE_SUBJECT_DIR)
+    bestRef_node.inputs.index_path = index_path
     preproc.connect(input_node, 'func', bestRef_node, 'in_file')
+    preproc.connect(entities_node, 'run_out_dir', bestRef_node, 'derivatives_dir')
+    preproc.connect(entities_node, 'prefix', bestRef_node, 'file_prefix')
 
     #the MCFLIRT node motion corrects the image
     motion_correct = pe.Node(interface=fsl.MCFLIRT(save_plots = True, save_rms= True), name='McFLIRT')
@@ -562,7 +791,8 @@ def buildWorkflow(patient_func_path, template_path, segment_path, outDir, subjec
 
 
     # we normalize the brain to 1000 as recommended by Power et al, however we normalize to median instead of the mode
-    normalization_node = pe.Node(interface=util.Function(input_names=['in_file', 'mask_file'], output_names=['out_file'], function=median_1000_normalization), name='Median1000Normalization')
+    normalization_node = pe.Node(interface=util.Function(input_names=['in_file', 'mask_file', 'dtype'], output_names=['out_file'], function=median_1000_normalization), name='Median1000Normalization')
+    normalization_node.inputs.dtype = dtype
     preproc.connect(apply_bet, 'out_file', normalization_node, 'in_file')
     preproc.connect(brain_extract, 'mask_file', normalization_node, 'mask_file')
 
@@ -596,7 +826,8 @@ def buildWorkflow(patient_func_path, template_path, segment_path, outDir, subjec
 
 
     #a custom function to calculate dvars as indicated by Power et al. We noticed that FSL's motionoutlier renormalized before calculating dvars, which is not desirable here
-    dvarsnode = pe.Node(interface=util.Function(input_names=['in_file', 'mask'], output_names=['outfile', 'outmetric', 'outplot_path'], function=MO_DVARS_Subprocess), name='dvars')
+    dvarsnode = pe.Node(interface=util.Function(input_names=['in_file', 'mask', 'dtype'], output_names=['outfile', 'outmetric', 'outplot_path'], function=MO_DVARS_Subprocess), name='dvars')
+    dvarsnode.inputs.dtype = dtype
     preproc.connect(smooth, 'smoothed_file', dvarsnode, 'in_file')
     preproc.connect(brain_extract, 'mask_file', dvarsnode, 'mask')
 
@@ -675,10 +906,52 @@ def buildWorkflow(patient_func_path, template_path, segment_path, outDir, subjec
     preproc.connect(segment_feed, 'segment', GetMaxROI_node, 'atlas_path')
 
     #the data extraction node takes in the BOLD and template images and extracts the necessary data (average voxel intensity per region, a similarity matrix, and a mapping dictionary)
-    CalcSimMatrix_node = pe.Node(interface=util.Function(input_names=['bold_path', 'template_path', 'maxSegVal'], output_names=['avg_arr_file', 'sim_matrix_file', 'mapping_dict_file'], function=CalcSimMatrix), name='CalcSimMatrix')
+    CalcSimMatrix_node = pe.Node(interface=util.Function(input_names=['bold_path', 'template_path', 'maxSegVal', 'dtype', 'atlas_path', 'dense'], output_names=['avg_arr_file', 'sim_matrix_file', 'mapping_dict_file', 'roi_labels_file'], function=CalcSimMatrix), name='CalcSimMatrix')
+    CalcSimMatrix_node.inputs.dtype = dtype
+    #the dense matrix is skipped when the blocked/sparse computation replaces it
+    sparse = sparseThreshold != None or sparseTopK != None
+    CalcSimMatrix_node.inputs.dense = not sparse
+    preproc.connect(segment_feed, 'segment', CalcSimMatrix_node, 'atlas_path')
     preproc.connect(GetMaxROI_node, 'max_roi', CalcSimMatrix_node, 'maxSegVal')
     preproc.connect(merge, 'merged_file', CalcSimMatrix_node, 'bold_path')
     preproc.connect(antsAppTrfm, 'output_image', CalcSimMatrix_node, 'template_path') # FSL Registation implementation
+
+    #the sparse connectivity node builds the similarity matrix block by block and only keeps the strongest edges
+    if sparse:
+        CalcSparseSimMatrix_node = pe.Node(interface=util.Function(input_names=['avg_arr_file', 'bold_path', 'mask_path', 'voxelwise', 'block_size', 'threshold', 'top_k', 'dtype', 'atlas_path'], output_names=['sparse_matrix_file', 'nodes_file'], function=CalcSparseSimMatrix), name='CalcSparseSimMatrix')
+        CalcSparseSimMatrix_node.inputs.dtype = dtype
+        preproc.connect(segment_feed, 'segment', CalcSparseSimMatrix_node, 'atlas_path')
+        CalcSparseSimMatrix_node.inputs.voxelwise = voxelwise
+        CalcSparseSimMatrix_node.inputs.block_size = blockSize
+        CalcSparseSimMatrix_node.inputs.threshold = sparseThreshold
+        CalcSparseSimMatrix_node.inputs.top_k = sparseTopK
+        preproc.connect(CalcSimMatrix_node, 'avg_arr_file', CalcSparseSimMatrix_node, 'avg_arr_file')
+        preproc.connect(merge, 'merged_file', CalcSparseSimMatrix_node, 'bold_path')
+        preproc.connect(brain_extract, 'mask_file', CalcSparseSimMatrix_node, 'mask_path')
+        preproc.connect(CalcSparseSimMatrix_node, 'sparse_matrix_file', datasink, DATATYPE_SUBJECT_DIR+'.@sparseSimilarityMatrix')
+        preproc.connect(CalcSparseSimMatrix_node, 'nodes_file', datasink, DATATYPE_SUBJECT_DIR+'.@sparseSimilarityNodes')
+
+    #the seed maps node correlates the signal of every ROI with every voxel of the preprocessed BOLD
+    if seedMaps:
+        CalcSeedMaps_node = pe.Node(interface=util.Function(input_names=['avg_arr_file', 'bold_path', 'mask_path', 'dtype', 'atlas_path'], output_names=['seed_maps_file', 'seed_labels_file'], function=CalcSeedMaps), name='CalcSeedMaps')
+        CalcSeedMaps_node.inputs.dtype = dtype
+        preproc.connect(segment_feed, 'segment', CalcSeedMaps_node, 'atlas_path')
+        preproc.connect(CalcSimMatrix_node, 'avg_arr_file', CalcSeedMaps_node, 'avg_arr_file')
+        preproc.connect(merge, 'merged_file', CalcSeedMaps_node, 'bold_path')
+        preproc.connect(brain_extract, 'mask_file', CalcSeedMaps_node, 'mask_path')
+        preproc.connect(CalcSeedMaps_node, 'seed_maps_file', datasink, DATATYPE_SUBJECT_DIR+'.@seedMaps')
+        preproc.connect(CalcSeedMaps_node, 'seed_labels_file', datasink, DATATYPE_SUBJECT_DIR+'.@seedMapsLabels')
+
+    #the dynamic connectivity node slides a window over the average array and writes one similarity matrix per window
+    if dynamicWindow != None:
+        CalcDynamicSimMatrix_node = pe.Node(interface=util.Function(input_names=['avg_arr_file', 'rejections_file', 'window_length', 'step', 'taper'], output_names=['dyn_matrix_file', 'dyn_info_file'], function=CalcDynamicSimMatrix), name='CalcDynamicSimMatrix')
+        CalcDynamicSimMatrix_node.inputs.window_length = dynamicWindow
+        CalcDynamicSimMatrix_node.inputs.step = dynamicStep
+        CalcDynamicSimMatrix_node.inputs.taper = dynamicTaper
+        preproc.connect(CalcSimMatrix_node, 'avg_arr_file', CalcDynamicSimMatrix_node, 'avg_arr_file')
+        preproc.connect(artifact_extract, 'rejectionsFile', CalcDynamicSimMatrix_node, 'rejections_file')
+        preproc.connect(CalcDynamicSimMatrix_node, 'dyn_matrix_file', datasink, DATATYPE_SUBJECT_DIR+'.@dynamicSimilarityMatrix')
+        preproc.connect(CalcDynamicSimMatrix_node, 'dyn_info_file', datasink, DATATYPE_SUBJECT_DIR+'.@dynamicSimilarityInfo')
     
 
     # Should always be outputted
@@ -686,7 +959,9 @@ def buildWorkflow(patient_func_path, template_path, segment_path, outDir, subjec
     preproc.connect(antsReg, 'warped_image', datasink, '{}.@warpedTemplate'.format(DATATYPE_SUBJECT_DIR))
     preproc.connect(antsAppTrfm, 'output_image', datasink, '{}.@warpedAtlas'.format(DATATYPE_SUBJECT_DIR))
     preproc.connect(CalcSimMatrix_node, 'avg_arr_file', datasink, DATATYPE_SUBJECT_DIR+'.@avgBoldSigPerRegion')
-    preproc.connect(CalcSimMatrix_node, 'sim_matrix_file', datasink, DATATYPE_SUBJECT_DIR+'.@similarityMatrix')
+    if not sparse:
+        preproc.connect(CalcSimMatrix_node, 'sim_matrix_file', datasink, DATATYPE_SUBJECT_DIR+'.@similarityMatrix')
+    preproc.connect(CalcSimMatrix_node, 'roi_labels_file', datasink, DATATYPE_SUBJECT_DIR+'.@roiLabels')
     preproc.connect(plotmotionmetrics_node, 'outfile_path', datasink, DATATYPE_SUBJECT_DIR+'.@fdvsdvars_plot')
 
 
@@ -734,37 +1009,70 @@ def main():
     session       = vetArgNone(args.session_id, None)
     template_path = vetArgNone(args.template, '/app/Template/MNI152lin_T1_2mm_brain.nii.gz') #path in docker container
     segment_path  = vetArgNone(args.segment, '/app/Template/AAL3v1_CombinedThalami.nii.gz') #path in docker container
+    n_procs       = int(vetArgNone(args.nprocs, 1))
+    dtype         = vetArgNone(args.dtype, DEFAULT_DTYPE)
+    dynamicWindow = vetArgNone(args.dynamicWindow, None)
+    dynamicStep   = int(vetArgNone(args.dynamicStep, 1))
+    dynamicTaper  = vetArgNone(args.dynamicTaper, 'rectangular')
+    if dynamicWindow != None:
+        dynamicWindow = int(dynamicWindow)
+    sparseThreshold = vetArgNone(args.sparseThreshold, None)
+    sparseTopK    = vetArgNone(args.sparseTopK, None)
+    blockSize     = int(vetArgNone(args.blockSize, 1024))
+    if sparseThreshold != None:
+        sparseThreshold = float(sparseThreshold)
+    if sparseTopK != None:
+        sparseTopK = int(sparseTopK)
+    if args.voxelwise and sparseThreshold == None and sparseTopK == None:
+        raise Exception("Voxelwise similarity matrices are only written sparsely. Please provide --sparseThreshold and/or --sparseTopK.")
+    # checked before anything runs, these would otherwise only fail in the last nodes after the whole preprocessing
+    if dynamicWindow != None and dynamicWindow < 3:
+        raise Exception("--dynamicWindow must be at least 3 frames.")
+    if dynamicStep < 1:
+        raise Exception("--dynamicStep must be at least 1 frame.")
+    if blockSize < 1:
+        raise Exception("--blockSize must be at least 1.")
     enforceBIDS   = True
     outDir        = makeOutDir(outDirName, args, enforceBIDS)
 
     if args.testmode:
         print("!!YOU ARE USING TEST MODE!!")
 
-    for i in os.listdir(args.parentDir[0]):
-        if i[:3] == 'ses':
-            if session == None:
-                raise Exception("Your data is sorted into sessions but you did not indicate a session to process. Please provide the Session.")
+    # atlas/template properties are precomputed once and shared by every subject
+    asc.ensureSidecar(segment_path, 'atlas')
+    asc.ensureSidecar(template_path, 'template')
 
-    if session != None:
-        patient_func_dir = os.path.join(args.parentDir[0], session, args.subject_id[0], DATATYPE_SUBJECT_DIR)
+    # every run of every session is processed in the same workflow
+    # the runs come from the dataset index, which only lists directories/reads headers that changed since the last refresh
+    index_path = None
+    if args.noIndex:
+        patient_func_runs = findSubjectRuns(data_dir, args.subject_id[0], session)
     else:
-        patient_func_dir = os.path.join(args.parentDir[0], args.subject_id[0], DATATYPE_SUBJECT_DIR)
-
-    ## The following behavior only takes the first T1 seen in the directory. 
-    ## The code could be expanded to account for multiple runs
-    patient_func_path = None
-    for i in os.listdir(patient_func_dir):
-        if i[-11:] =='{}.nii.gz'.format(DATATYPE_FILE_SUFFIX):
-            patient_func_path = os.path.join(patient_func_dir, i)
-
-    if patient_func_path == None:
+        index_path = os.path.abspath(vetArgNone(args.index, os.path.join(os.path.dirname(outDir), di.INDEX_FILE_NAME)))
+        index = di.openIndex(index_path)
+        di.refreshIndex(index, data_dir, [args.subject_id[0]])
+        patient_func_runs = di.lookupRuns(index, data_dir, args.subject_id[0], session)
+        index.close()
+    patient_func_paths = [path for path, run_session in patient_func_runs]
+    patient_sessions   = [run_session for path, run_session in patient_func_runs]
+
+    if len(patient_func_paths) == 0:
         print('Error: No {} images found for the specified patient. The pipeline cannot proceed. Please ensure that all filenames adhere to the BIDS standard. No NIFTI files with the extension \'_{}.nii.gz\' were detected. Exiting...'.format(DATATYPE_FILE_SUFFIX.upper(), DATATYPE_FILE_SUFFIX))
+        # non-zero so that callers (e.g. job_queue.py) do not record the subject as done
+        sys.exit(1)
     else:
-        preproc = buildWorkflow(patient_func_path, template_path, segment_path, outDir, args.subject_id[0], args.testmode, args.saveIntermediates)
+        print('Found {} {} run(s) to preprocess:'.format(len(patient_func_paths), DATATYPE_FILE_SUFFIX.upper()))
+        for patient_func_path, patient_session in patient_func_runs:
+            print('\t{}{}'.format(patient_func_path, ' ({})'.format(patient_session) if patient_session != '' else ''))
+
+        preproc = buildWorkflow(patient_func_paths, template_path, segment_path, outDir, args.subject_id[0], args.testmode, args.saveIntermediates, dynamicWindow, dynamicStep, dynamicTaper, sparseThreshold, sparseTopK, blockSize, args.voxelwise, args.seedMaps, dtype, index_path, patient_sessions)
         tic = time.time()
-        preproc.run()
+        if n_procs > 1:
+            preproc.run(plugin='MultiProc', plugin_args={'n_procs': n_procs})
+        else:
+            preproc.run()
         toc = time.time()
-        print('\nElapsed Time to Preprocess: {}s\n'.format(tic-toc))
+        print('\nElapsed Time to Preprocess: {}s\n'.format(toc-tic))
 
 
 
@@ -0,0 +1,271 @@
+################################################################################
+# Author:  Joy Roy, William Reynolds, Rafael Ceschin
+# Purpose: One-time precompute of atlas/template properties. A JSON sidecar is
+#          written next to each atlas (label set, label names, voxel counts,
+#          bounding boxes) and template (intensity range, brain bounding box),
+#          together with downsampled pyramid levels. Pipeline nodes read the
+#          sidecar instead of reloading the full image for every subject.
+#
+# Contact: jor115@pitt.edu
+################################################################################
+import argparse
+import hashlib
+import json
+import nibabel as nib
+import numpy as np
+import os, sys
+
+
+SIDECAR_SUFFIX  = '_sidecar.json'
+SIDECAR_VERSION = 2 # sidecars of an older version are rebuilt
+PYRAMID_FACTORS = (2, 4)
+
+
+def makeParser():
+    parser = argparse.ArgumentParser(
+                        prog='Sim_Funky_Pipeline_Sidecars',
+                        usage='This program precomputes the sidecars (label sets, names, voxel counts, bounding boxes and pyramids) of atlases and templates',
+                        epilog='BUG REPORTING: Report bugs to pirc@chp.edu or more directly to Joy Roy at the Childrens Hospital of Pittsburgh.'
+        )
+    parser.add_argument('-seg','--atlas', nargs='+', required=False, default=[],
+                        help='Atlases (label images) to precompute.')
+    parser.add_argument('-tem','--template', nargs='+', required=False, default=[],
+                        help='Templates (intensity images) to precompute.')
+    parser.add_argument('-l','--labels', nargs=1, required=False,
+                        help='Text file with the label names (\'index name ...\' per line). Default is the .txt file found next to each atlas, e.g. AAL3v1.nii.txt for AAL3v1_CombinedThalami.nii.gz.')
+    parser.add_argument('--force', required=False, action='store_true',
+                        help='Recomputes sidecars that are still up to date.')
+    return parser
+
+
+def imageBase(image_path):
+    for ext in ('.nii.gz', '.nii'):
+        if image_path.endswith(ext):
+            return image_path[:-len(ext)]
+    return os.path.splitext(image_path)[0]
+
+
+def sidecarPath(image_path):
+    return imageBase(image_path) + SIDECAR_SUFFIX
+
+
+def hashFile(path, blocksize=1<<20):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+# Note: label names come from an 'index name [value]' text file like AAL3v1.nii.txt.
+#       The first column is the label value.
+def readLabelNames(labels_txt):
+    names = {}
+    with open(labels_txt, 'r') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) >= 2 and fields[0].isdigit():
+                names[int(fields[0])] = fields[1]
+    return names
+
+
+# Note: looks for <atlas>.nii.txt or <atlas>.txt, dropping trailing '_xxx' parts of
+#       the name until one is found (AAL3v1_CombinedThalami_444 -> AAL3v1_CombinedThalami -> AAL3v1)
+def findLabelNames(atlas_path):
+    base = imageBase(atlas_path)
+    while True:
+        for candidate in (base + '.nii.txt', base + '.txt'):
+            if os.path.exists(candidate):
+                return candidate
+        if '_' not in os.path.basename(base):
+            return None
+        base = base[:base.rindex('_')]
+
+
+def downsampleLabels(data, affine, factor):
+    # nearest neighbour: every factor-th voxel keeps its label
+    scale = np.diag([factor, factor, factor, 1.])
+    return data[::factor, ::factor, ::factor], affine.dot(scale)
+
+
+def downsampleIntensities(data, affine, factor):
+    # block mean over factor^3 voxels, the new voxel sits at the centre of its block
+    shape = [s // factor for s in data.shape[:3]]
+    cropped = data[:shape[0]*factor, :shape[1]*factor, :shape[2]*factor]
+    blocks = cropped.reshape(shape[0], factor, shape[1], factor, shape[2], factor)
+    scale = np.diag([factor, factor, factor, 1.])
+    scale[:3, 3] = (factor - 1) / 2.
+    return blocks.mean(axis=(1, 3, 5)), affine.dot(scale)
+
+
+def boundingBox(mask):
+    ijk = np.argwhere(mask)
+    if len(ijk) == 0:
+        return None
+    return [ijk.min(axis=0).tolist(), ijk.max(axis=0).tolist()]
+
+
+# Note: writes the sidecar (and pyramid levels) of an atlas ('atlas') or template
+#       ('template'). Files are written under a temporary name and renamed, so
+#       several hosts precomputing the same atlas never see half written files.
+def buildSidecar(image_path, kind='atlas', labels_txt=None, factors=PYRAMID_FACTORS):
+    img = nib.load(image_path)
+    stat = os.stat(image_path)
+    sidecar = {'Version': SIDECAR_VERSION,
+               'Kind': kind,
+               'Source': {'File': os.path.basename(image_path), 'Size': stat.st_size, 'Mtime': stat.st_mtime, 'SHA1': hashFile(image_path)},
+               'Shape': list(img.shape),
+               'Zooms': [float(z) for z in img.header.get_zooms()],
+               'Affine': img.affine.tolist(),
+               'Pyramid': []}
+
+    if kind == 'atlas':
+        data = np.rint(np.asanyarray(img.dataobj)).astype(np.int32)
+        if labels_txt == None:
+            labels_txt = findLabelNames(image_path)
+        names = readLabelNames(labels_txt) if labels_txt != None else {}
+
+        counts = np.bincount(data[data > 0].ravel(), minlength=1)
+        labels = [int(l) for l in np.nonzero(counts)[0]]
+        sidecar['LabelNamesFile'] = os.path.basename(labels_txt) if labels_txt != None else None
+        sidecar['MaxLabel'] = int(data.max())
+        sidecar['Labels'] = labels
+        # every label of the names file is kept (not only those present in the atlas) so
+        # that names never depend on whether a sidecar exists; VoxelCounts tells which are present
+        sidecar['LabelNames'] = {str(l): names[l] for l in sorted(names)}
+        for l in labels:
+            sidecar['LabelNames'].setdefault(str(l), 'ROI_{}'.format(l))
+        sidecar['VoxelCounts'] = {str(l): int(counts[l]) for l in labels}
+        sidecar['BoundingBoxes'] = {}
+        for l, box in zip(labels, labelBoundingBoxes(data, labels)):
+            sidecar['BoundingBoxes'][str(l)] = box
+        out_dtype = np.int16 if sidecar['MaxLabel'] < 2**15 else np.int32
+    else:
+        data = np.asanyarray(img.dataobj).astype(np.float32)
+        sidecar['Min'] = float(data.min())
+        sidecar['Max'] = float(data.max())
+        sidecar['NonzeroVoxels'] = int(np.count_nonzero(data))
+        sidecar['BoundingBox'] = boundingBox(data != 0)
+        out_dtype = np.float32
+
+    for factor in factors:
+        if kind == 'atlas':
+            level, affine = downsampleLabels(data, img.affine, factor)
+        else:
+            level, affine = downsampleIntensities(data, img.affine, factor)
+        level_img = nib.Nifti1Image(level.astype(out_dtype), affine)
+        level_img.set_data_dtype(out_dtype)
+        level_path = '{}_pyr-{}.nii.gz'.format(imageBase(image_path), factor)
+        tmp_path = '{}.tmp{}.nii.gz'.format(imageBase(level_path), os.getpid())
+        nib.save(level_img, tmp_path)
+        os.replace(tmp_path, level_path)
+        sidecar['Pyramid'].append({'Factor': factor, 'File': os.path.basename(level_path), 'Shape': list(level.shape)})
+
+    sidecar_file = sidecarPath(image_path)
+    tmp_path = '{}.tmp{}'.format(sidecar_file, os.getpid())
+    with open(tmp_path, 'w') as fp:
+        json.dump(sidecar, fp, indent = 4)
+    os.replace(tmp_path, sidecar_file)
+    return sidecar_file
+
+
+# Note: bounding boxes of all labels from one sort of the labelled voxels instead
+#       of one full-volume comparison per label
+def labelBoundingBoxes(data, labels):
+    ijk = np.argwhere(data > 0)
+    values = data[data > 0]
+    order = np.argsort(values, kind='stable')
+    ijk, values = ijk[order], values[order]
+    starts = np.searchsorted(values, labels, side='left')
+    stops  = np.searchsorted(values, labels, side='right')
+    return [[ijk[a:b].min(axis=0).tolist(), ijk[a:b].max(axis=0).tolist()] for a, b in zip(starts, stops)]
+
+
+# Note: returns the sidecar of an image, or None if there is none or the image
+#       changed since it was written. The size and mtime are checked first; the
+#       content hash is only needed when the mtime changed (e.g. after a copy).
+def loadSidecar(image_path):
+    sidecar_file = sidecarPath(image_path)
+    if not os.path.exists(sidecar_file):
+        return None
+    with open(sidecar_file, 'r') as fp:
+        sidecar = json.load(fp)
+    if sidecar.get('Version') != SIDECAR_VERSION:
+        return None
+    stat = os.stat(image_path)
+    if sidecar['Source']['Size'] != stat.st_size:
+        return None
+    if sidecar['Source']['Mtime'] != stat.st_mtime and sidecar['Source']['SHA1'] != hashFile(image_path):
+        return None
+    return sidecar
+
+
+# Note: makes sure an up to date sidecar exists. Returns None (instead of failing)
+#       if the sidecar cannot be written, e.g. for an atlas on read-only storage.
+def ensureSidecar(image_path, kind='atlas', labels_txt=None, force=False):
+    if not force:
+        sidecar = loadSidecar(image_path)
+        if sidecar != None:
+            return sidecar
+    try:
+        buildSidecar(image_path, kind, labels_txt)
+    except OSError as e:
+        print('Could not write the sidecar of {}: {}'.format(image_path, e))
+        return None
+    return loadSidecar(image_path)
+
+
+# Note: names for the columns 0..numROIs-1 of an average array. The sidecar is
+#       used if there is one, otherwise the label names file next to the atlas;
+#       both hold the full name table, so the names are the same either way.
+def roiLabelNames(atlas_path, numROIs):
+    names = {}
+    sidecar = loadSidecar(atlas_path) if atlas_path != None else None
+    if sidecar != None:
+        names = {int(l): n for l, n in sidecar['LabelNames'].items()}
+    elif atlas_path != None:
+        labels_txt = findLabelNames(atlas_path)
+        if labels_txt != None:
+            names = readLabelNames(labels_txt)
+    roi_names = ['Background']
+    for l in range(1, numROIs):
+        roi_names.append(names.get(l, 'ROI_{}'.format(l)))
+    return roi_names[:numROIs]
+
+
+# Note: writes a table of the columns of an average array: ROI index, label name
+#       and (from the sidecar) the number of atlas voxels of the ROI, 0 for labels
+#       that are named but not present in the atlas.
+def writeROILabels(atlas_path, numROIs, out_file):
+    names = roiLabelNames(atlas_path, numROIs)
+    sidecar = loadSidecar(atlas_path) if atlas_path != None else None
+    counts = sidecar['VoxelCounts'] if sidecar != None else {}
+    with open(out_file, 'w') as f:
+        f.write('roi\tname\tatlas_voxels\n')
+        for roi in range(numROIs):
+            count = counts.get(str(roi), 0 if sidecar != None and roi > 0 else 'n/a')
+            f.write('{}\t{}\t{}\n'.format(roi, names[roi], count))
+    return out_file
+
+
+def main():
+    parser = makeParser()
+    args   = parser.parse_args()
+    labels_txt = args.labels[0] if args.labels != None else None
+
+    for atlas_path in args.atlas:
+        sidecar = ensureSidecar(atlas_path, 'atlas', labels_txt, args.force)
+        if sidecar != None:
+            print('{}: {} labels (max {}), names from {}'.format(atlas_path, len(sidecar['Labels']), sidecar['MaxLabel'], sidecar['LabelNamesFile']))
+    for template_path in args.template:
+        sidecar = ensureSidecar(template_path, 'template', None, args.force)
+        if sidecar != None:
+            print('{}: {} nonzero voxels'.format(template_path, sidecar['NonzeroVoxels']))
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("\n\tReceived Keyboard Interrupt, ending program.\n")
+        sys.exit(2)
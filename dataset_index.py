@@ -0,0 +1,262 @@
+################################################################################
+# Author:  Joy Roy, William Reynolds, Rafael Ceschin
+# Purpose: Persistent index of the BOLD runs of a dataset. Subjects, sessions,
+#          runs, file sizes/mtimes, image shape, TR and a content hash are kept
+#          in a SQLite file so that neither the CLI nor the pipeline nodes need
+#          to list directories or open NIFTI headers again. The index is
+#          refreshed incrementally: a directory is only listed again if its
+#          mtime changed and a header is only read again if the file's size or
+#          mtime changed.
+#
+# Contact: jor115@pitt.edu
+################################################################################
+import argparse
+import hashlib
+import json
+import os, sys
+import sqlite3
+import time
+
+
+DATATYPE_SUBJECT_DIR = 'func'
+DATATYPE_FILE_SUFFIX = 'bold'
+INDEX_FILE_NAME = 'dataset_index.db'
+
+
+def makeParser():
+    parser = argparse.ArgumentParser(
+                        prog='Sim_Funky_Pipeline_Index',
+                        usage='This program builds or refreshes the dataset index used by the pipeline to find BOLD runs and their header information',
+                        epilog='BUG REPORTING: Report bugs to pirc@chp.edu or more directly to Joy Roy at the Childrens Hospital of Pittsburgh.'
+        )
+    parser.add_argument('-p','--parentDir', nargs=1, required=True,
+                        help='Path to the parent data directory. BIDS compatible datasets are encouraged.')
+    parser.add_argument('-i','--index', nargs=1, required=True,
+                        help='Path to the index file. It is created if it does not exist.')
+    parser.add_argument('-sid','--subject_id', nargs='+', required=False,
+                        help='Only refreshes these subjects. Default is the whole dataset.')
+    parser.add_argument('--noHash', required=False, action='store_true',
+                        help='Skips the content hash of runs that have none yet. Hashing reads every byte of the new or changed runs.')
+    parser.add_argument('--list', required=False, action='store_true',
+                        help='Prints the indexed runs after the refresh.')
+    return parser
+
+
+def openIndex(index_path, timeout=60.):
+    conn = sqlite3.connect(index_path, timeout=timeout, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute('''CREATE TABLE IF NOT EXISTS dirs (
+                        path    TEXT PRIMARY KEY,
+                        mtime   REAL NOT NULL,
+                        entries TEXT NOT NULL)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS runs (
+                        path    TEXT PRIMARY KEY,
+                        parent  TEXT NOT NULL,
+                        subject TEXT NOT NULL,
+                        session TEXT NOT NULL DEFAULT '',
+                        run     TEXT NOT NULL,
+                        size    INTEGER NOT NULL,
+                        mtime   REAL NOT NULL,
+                        shape   TEXT,
+                        tr      REAL,
+                        sha1    TEXT,
+                        indexed REAL)''')
+    conn.execute('CREATE INDEX IF NOT EXISTS runs_subject ON runs (parent, subject, session)')
+    return conn
+
+
+# Note: lists a directory through the index. The listing is only redone when the
+#       directory's mtime changed (an entry was added, removed or renamed), so an
+#       unchanged directory costs a single stat. Returns [] for missing directories.
+#       Without an index (conn=None) the directory is simply listed.
+def listDir(conn, path):
+    if conn == None:
+        try:
+            return sorted(os.listdir(path))
+        except OSError:
+            return []
+    try:
+        mtime = os.stat(path).st_mtime
+        row = conn.execute('SELECT mtime, entries FROM dirs WHERE path = ?', (path,)).fetchone()
+        if row != None and row['mtime'] == mtime:
+            return json.loads(row['entries'])
+        entries = sorted(os.listdir(path))
+    except OSError:
+        conn.execute('DELETE FROM dirs WHERE path = ?', (path,))
+        return []
+
+    conn.execute('INSERT OR REPLACE INTO dirs (path, mtime, entries) VALUES (?, ?, ?)', (path, mtime, json.dumps(entries)))
+    return entries
+
+
+def hashFile(path, blocksize=1<<20):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+# Note: the func folders of a dataset in the layout used so far
+#       (parentDir/ses-X/sub-Y/func) and in standard BIDS (parentDir/sub-Y[/ses-X]/func).
+#       Both layouts may be mixed. This is the one place the dataset layout is
+#       walked; Pipeline.py and job_queue.py call it (with conn=None when no index is used).
+def findFuncDirs(conn, parentDir, subjects=None):
+    func_dirs = []
+    for i in listDir(conn, parentDir):
+        if i[:3] == 'ses':
+            for subject in listDir(conn, os.path.join(parentDir, i)):
+                if subject[:4] == 'sub-' and (subjects == None or subject in subjects):
+                    func_dirs.append((subject, i, os.path.join(parentDir, i, subject, DATATYPE_SUBJECT_DIR)))
+        elif i[:4] == 'sub-' and (subjects == None or i in subjects):
+            subject_dir = os.path.join(parentDir, i)
+            for j in listDir(conn, subject_dir):
+                if j == DATATYPE_SUBJECT_DIR:
+                    func_dirs.append((i, '', os.path.join(subject_dir, j)))
+                elif j[:3] == 'ses':
+                    func_dirs.append((i, j, os.path.join(subject_dir, j, DATATYPE_SUBJECT_DIR)))
+    return func_dirs
+
+
+# Note: every BOLD run of the dataset (or of the given subjects) as (subject, session, path)
+def findRuns(conn, parentDir, subjects=None):
+    runs = []
+    for subject, session, func_dir in findFuncDirs(conn, parentDir, subjects):
+        for i in listDir(conn, func_dir):
+            if i.endswith('_{}.nii.gz'.format(DATATYPE_FILE_SUFFIX)):
+                runs.append((subject, session, os.path.join(func_dir, i)))
+    return runs
+
+
+def readHeader(path):
+    import nibabel as nib
+    img = nib.load(path)
+    return list(img.shape), float(img.header.get_zooms()[-1])
+
+
+# Note: brings the index of parentDir (or only of the given subjects) up to date.
+#       Returns the number of runs whose header was (re)read. Content hashes read
+#       every byte of a run, so by default they are left to hashRuns (startHashing
+#       runs it in the background) instead of being computed here.
+def refreshIndex(conn, parentDir, subjects=None, hash_files=False):
+    parentDir = os.path.abspath(parentDir)
+    if subjects != None:
+        subjects = set(subjects)
+    updated = 0
+    seen = set()
+    for subject, session, path in findRuns(conn, parentDir, subjects):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        seen.add(path)
+        row = conn.execute('SELECT size, mtime FROM runs WHERE path = ?', (path,)).fetchone()
+        if row != None and row['size'] == stat.st_size and row['mtime'] == stat.st_mtime:
+            continue
+
+        shape, tr = readHeader(path)
+        sha1 = hashFile(path) if hash_files else None
+        run = os.path.basename(path)[:-len('_{}.nii.gz'.format(DATATYPE_FILE_SUFFIX))]
+        conn.execute('INSERT OR REPLACE INTO runs (path, parent, subject, session, run, size, mtime, shape, tr, sha1, indexed) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                     (path, parentDir, subject, session, run, stat.st_size, stat.st_mtime, json.dumps(shape), tr, sha1, time.time()))
+        updated += 1
+
+    # forget runs that disappeared from the refreshed part of the dataset
+    for row in conn.execute('SELECT path, subject FROM runs WHERE parent = ?', (parentDir,)).fetchall():
+        if row['path'] not in seen and (subjects == None or row['subject'] in subjects):
+            conn.execute('DELETE FROM runs WHERE path = ?', (row['path'],))
+
+    return updated
+
+
+# Note: fills in the content hash of indexed runs that have none yet. A hash is only
+#       stored if the file did not change while it was read. Returns the number of
+#       runs hashed.
+def hashRuns(conn, parentDir, subjects=None):
+    parentDir = os.path.abspath(parentDir)
+    hashed = 0
+    for row in conn.execute('SELECT path, subject FROM runs WHERE parent = ? AND sha1 IS NULL ORDER BY path', (parentDir,)).fetchall():
+        if subjects != None and row['subject'] not in subjects:
+            continue
+        # another hashing pass may have got there first
+        if conn.execute('SELECT sha1 FROM runs WHERE path = ?', (row['path'],)).fetchone()['sha1'] != None:
+            continue
+        try:
+            sha1 = hashFile(row['path'])
+            stat = os.stat(row['path'])
+        except OSError:
+            continue
+        cursor = conn.execute('UPDATE runs SET sha1 = ? WHERE path = ? AND size = ? AND mtime = ?', (sha1, row['path'], stat.st_size, stat.st_mtime))
+        hashed += cursor.rowcount
+    return hashed
+
+
+# Note: runs this script (refresh + hashRuns) as a background process, so that
+#       enqueueing a cohort never waits for the content hashes. Pipeline.py does
+#       not start it: one hashing process per job would re-read every run.
+def startHashing(index_path, parentDir, subjects=None):
+    import subprocess
+    command = [sys.executable, os.path.abspath(__file__), '-p', os.path.abspath(parentDir), '-i', os.path.abspath(index_path)]
+    if subjects != None:
+        command += ['-sid'] + list(subjects)
+    return subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+
+
+# Note: the (path, session) pairs of a subject's runs (all sessions unless one is
+#       given), same as Pipeline.findSubjectRuns but answered from the index.
+def lookupRuns(conn, parentDir, subject, session=None):
+    parentDir = os.path.abspath(parentDir)
+    if session != None:
+        rows = conn.execute('SELECT path, session FROM runs WHERE parent = ? AND subject = ? AND session = ? ORDER BY session, path', (parentDir, subject, session))
+    else:
+        rows = conn.execute('SELECT path, session FROM runs WHERE parent = ? AND subject = ? ORDER BY session, path', (parentDir, subject))
+    return [(row['path'], row['session']) for row in rows]
+
+
+# Note: shape and TR of an indexed run, or None if the file is not indexed or
+#       changed since (so callers fall back to reading the header themselves)
+def lookupHeader(index_path, path):
+    if index_path == None or not os.path.exists(index_path):
+        return None
+    conn = openIndex(index_path)
+    row = conn.execute('SELECT size, mtime, shape, tr FROM runs WHERE path = ?', (os.path.abspath(path),)).fetchone()
+    conn.close()
+    if row == None:
+        return None
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    if row['size'] != stat.st_size or row['mtime'] != stat.st_mtime:
+        return None
+    return json.loads(row['shape']), row['tr']
+
+
+def main():
+    parser = makeParser()
+    args   = parser.parse_args()
+
+    conn = openIndex(args.index[0])
+    tic = time.time()
+    updated = refreshIndex(conn, args.parentDir[0], args.subject_id)
+    toc = time.time()
+    total = conn.execute('SELECT COUNT(*) FROM runs WHERE parent = ?', (os.path.abspath(args.parentDir[0]),)).fetchone()[0]
+    print('Indexed {} run(s), {} new or changed, in {:.2f}s'.format(total, updated, toc-tic))
+    if not args.noHash:
+        tic = time.time()
+        hashed = hashRuns(conn, args.parentDir[0], args.subject_id)
+        toc = time.time()
+        print('Hashed {} run(s) in {:.2f}s'.format(hashed, toc-tic))
+
+    if args.list:
+        for row in conn.execute('SELECT * FROM runs WHERE parent = ? ORDER BY subject, session, run', (os.path.abspath(args.parentDir[0]),)):
+            print('{}\t{}\t{}\tshape={}\tTR={}\tsha1={}'.format(row['subject'], row['session'], row['run'], row['shape'], row['tr'], row['sha1']))
+    conn.close()
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("\n\tReceived Keyboard Interrupt, ending program.\n")
+        sys.exit(2)
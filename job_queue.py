@@ -0,0 +1,414 @@
+################################################################################
+# Author:  Joy Roy, William Reynolds, Rafael Ceschin
+# Purpose: Queue driven execution of the pipeline over many subjects/sessions.
+#          Jobs live in a SQLite file on shared storage. Any number of workers
+#          (on any number of hosts) pull jobs from it: a claimed job carries a
+#          lease that the worker renews with a heartbeat, jobs whose lease ran
+#          out are picked up again, failed jobs are retried with exponential
+#          backoff and the result of every attempt is recorded per job.
+#
+# Contact: jor115@pitt.edu
+################################################################################
+import argparse
+import json
+import os, sys
+import shlex
+import signal
+import socket
+import sqlite3
+import subprocess
+import threading
+import time
+import dataset_index as di
+
+
+LEASE_SECONDS     = 300.
+HEARTBEAT_SECONDS = 60.
+BACKOFF_SECONDS   = 60.
+MAX_BACKOFF_SECONDS = 3600.
+MAX_ATTEMPTS      = 3
+POLL_SECONDS      = 10.
+MAX_HEARTBEAT_FAILURES = 3
+TERMINATE_GRACE_SECONDS = 30.
+PIPELINE_SCRIPT   = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Pipeline.py')
+
+
+def makeParser():
+    parser = argparse.ArgumentParser(
+                        prog='Sim_Funky_Pipeline_Queue',
+                        usage='This program distributes subjects/sessions over any number of workers through a shared job queue',
+                        epilog='BUG REPORTING: Report bugs to pirc@chp.edu or more directly to Joy Roy at the Childrens Hospital of Pittsburgh.'
+        )
+    subparsers = parser.add_subparsers(dest='mode')
+    subparsers.required = True
+
+    enqueue = subparsers.add_parser('enqueue', help='Adds one job per subject/session to the queue. Jobs already in the queue are left alone.')
+    enqueue.add_argument('-q','--queue', nargs=1, required=True,
+                        help='Path to the SQLite queue file. It must be on storage shared by all worker hosts.')
+    enqueue.add_argument('-p','--parentDir', nargs=1, required=True,
+                        help='Path to the parent data directory. BIDS compatible datasets are encouraged.')
+    enqueue.add_argument('-o','--ourDir', nargs=1, required=True,
+                        help='Path to the \'derivatives\' folder or chosen out folder, passed to every job.')
+    enqueue.add_argument('-sid','--subject_id', nargs='+', required=False,
+                        help='Subjects to enqueue. Default is every sub-* folder of the parent directory.')
+    enqueue.add_argument('--index', nargs=1, required=False,
+                        help='Finds the subjects/sessions through the dataset index (see dataset_index.py) instead of listing the parent directory.')
+    enqueue.add_argument('--noHash', required=False, action='store_true',
+                        help='With --index, does not start the background content hash of new or changed runs.')
+    enqueue.add_argument('--maxAttempts', nargs=1, required=False,
+                        help='Number of times a job is tried before it is marked as failed. Default is {}.'.format(MAX_ATTEMPTS))
+    enqueue.add_argument('--command', nargs=1, required=False,
+                        help='Command run for every job instead of Pipeline.py. {subject}, {session}, {parentDir} and {outDir} are replaced per job.')
+    enqueue.add_argument('pipeline_args', nargs=argparse.REMAINDER,
+                        help='Further arguments passed on to Pipeline.py (after --), e.g. -- --testmode -n 4')
+
+    worker = subparsers.add_parser('worker', help='Pulls jobs from the queue and runs them until no work is left.')
+    worker.add_argument('-q','--queue', nargs=1, required=True,
+                        help='Path to the SQLite queue file.')
+    worker.add_argument('--workerId', nargs=1, required=False,
+                        help='Name of this worker. Default is hostname:pid.')
+    worker.add_argument('--logDir', nargs=1, required=False,
+                        help='Directory for the log of every attempt. Default is a \'logs\' folder next to the queue.')
+    worker.add_argument('--lease', nargs=1, required=False,
+                        help='Seconds a claimed job is reserved without a heartbeat. Default is {}.'.format(int(LEASE_SECONDS)))
+    worker.add_argument('--heartbeat', nargs=1, required=False,
+                        help='Seconds between two heartbeats. Default is {}.'.format(int(HEARTBEAT_SECONDS)))
+    worker.add_argument('--backoff', nargs=1, required=False,
+                        help='Seconds before the first retry of a failed job, doubled on every further attempt. Default is {}.'.format(int(BACKOFF_SECONDS)))
+    worker.add_argument('--poll', nargs=1, required=False,
+                        help='Seconds between two looks at the queue while waiting for work. Default is {}.'.format(int(POLL_SECONDS)))
+    worker.add_argument('--wait', required=False, action='store_true',
+                        help='Keeps waiting for new jobs instead of exiting once the queue is finished.')
+
+    status = subparsers.add_parser('status', help='Summarizes the queue.')
+    status.add_argument('-q','--queue', nargs=1, required=True,
+                        help='Path to the SQLite queue file.')
+    status.add_argument('--jobs', required=False, action='store_true',
+                        help='Lists every job and the result of its last attempt.')
+
+    return parser
+
+
+# This was developed instead of using the default parameter in the argparser
+# bc argparser only returns a list or None and you can't do None[0].
+def vetArgNone(variable, default):
+    if variable==None:
+        return default
+    else:
+        return variable[0]
+
+
+# Note: every process (and thread) opens its own connection. Transactions that
+#       claim or update jobs use BEGIN IMMEDIATE so that only one worker at a
+#       time can change the queue; the others wait up to 'timeout' seconds.
+def connectQueue(queue_path, timeout=60.):
+    conn = sqlite3.connect(queue_path, timeout=timeout, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                        id            INTEGER PRIMARY KEY AUTOINCREMENT,
+                        subject       TEXT NOT NULL,
+                        session       TEXT NOT NULL DEFAULT '',
+                        command       TEXT NOT NULL,
+                        status        TEXT NOT NULL DEFAULT 'pending',
+                        attempts      INTEGER NOT NULL DEFAULT 0,
+                        max_attempts  INTEGER NOT NULL DEFAULT {},
+                        not_before    REAL NOT NULL DEFAULT 0,
+                        worker        TEXT,
+                        lease_expires REAL,
+                        heartbeat     REAL,
+                        created       REAL,
+                        started       REAL,
+                        finished      REAL,
+                        returncode    INTEGER,
+                        UNIQUE(subject, session))'''.format(MAX_ATTEMPTS))
+    conn.execute('''CREATE TABLE IF NOT EXISTS results (
+                        job_id     INTEGER NOT NULL,
+                        attempt    INTEGER NOT NULL,
+                        worker     TEXT,
+                        started    REAL,
+                        finished   REAL,
+                        returncode INTEGER,
+                        log_file   TEXT,
+                        message    TEXT)''')
+    return conn
+
+
+# Note: finds the subject/session pairs of a dataset. Both the layout used by
+#       Pipeline.py (parentDir/ses-X/sub-Y) and standard BIDS (parentDir/sub-Y/ses-X)
+#       are recognized (the walk is dataset_index.findFuncDirs). Subjects without
+#       sessions get an empty session. Only subjects/sessions that have BOLD runs
+#       are returned, with or without a dataset index.
+#       A job with an empty session runs Pipeline.py without -ses_id, which takes
+#       every session of the subject. A subject that has runs both outside and inside
+#       session folders therefore gets that one job only, never per-session jobs next
+#       to it (they would process the same runs into the same outputs).
+def discoverJobs(parentDir, subjects=None, index_path=None, hash_files=True):
+    jobs = []
+    if index_path != None:
+        index = di.openIndex(index_path)
+        di.refreshIndex(index, parentDir, subjects)
+        # hashing the whole cohort would read every byte before the first job is queued
+        if hash_files:
+            di.startHashing(index_path, parentDir, subjects)
+        for row in index.execute('SELECT DISTINCT subject, session FROM runs WHERE parent = ? ORDER BY subject, session', (os.path.abspath(parentDir),)):
+            jobs.append((row['subject'], row['session']))
+        index.close()
+    else:
+        for subject, session, path in di.findRuns(None, parentDir, subjects):
+            if (subject, session) not in jobs:
+                jobs.append((subject, session))
+
+    whole_subjects = set(subject for subject, session in jobs if session == '')
+    return sorted(set((subject, session) for subject, session in jobs if subject not in whole_subjects or session == ''))
+
+
+# Note: only the arguments of Pipeline.py are stored with a job. The interpreter and
+#       the location of Pipeline.py are resolved by the worker that runs the job
+#       (see jobCommand), since they differ between the enqueuing host and the workers.
+def pipelineArgs(parentDir, outDir, subject, session, pipeline_args=None):
+    arguments = ['-p', parentDir, '-sid', subject, '-o', outDir]
+    if session != '':
+        arguments += ['-ses_id', session]
+    if pipeline_args != None:
+        arguments += [a for a in pipeline_args if a != '--']
+    return {'pipeline_args': arguments}
+
+
+# Note: the command line of a job on this worker. Jobs made with --command are
+#       stored as a full command line and run as they are.
+def jobCommand(job):
+    command = json.loads(job['command'])
+    if isinstance(command, dict):
+        return [sys.executable, PIPELINE_SCRIPT] + command['pipeline_args']
+    return command
+
+
+def enqueueJob(conn, subject, session, command, max_attempts=MAX_ATTEMPTS):
+    cursor = conn.execute('INSERT OR IGNORE INTO jobs (subject, session, command, max_attempts, created) VALUES (?, ?, ?, ?, ?)',
+                          (subject, session, json.dumps(command), int(max_attempts), time.time()))
+    return cursor.rowcount == 1
+
+
+def backoffDelay(attempts, backoff=BACKOFF_SECONDS):
+    return min(MAX_BACKOFF_SECONDS, backoff * 2 ** max(attempts - 1, 0))
+
+
+# Note: claims the next runnable job for this worker. Jobs whose lease ran out
+#       (the worker died or lost its connection) count as a failed attempt and are
+#       either put back with backoff or marked as failed. Returns None if there is
+#       nothing to run right now.
+def claimJob(conn, worker_id, lease=LEASE_SECONDS, backoff=BACKOFF_SECONDS):
+    now = time.time()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        expired = conn.execute("SELECT * FROM jobs WHERE status = 'running' AND lease_expires < ?", (now,)).fetchall()
+        for job in expired:
+            conn.execute('INSERT INTO results (job_id, attempt, worker, started, finished, message) VALUES (?, ?, ?, ?, ?, ?)',
+                         (job['id'], job['attempts'], job['worker'], job['started'], now, 'lease expired'))
+            if job['attempts'] >= job['max_attempts']:
+                conn.execute("UPDATE jobs SET status = 'failed', finished = ? WHERE id = ?", (now, job['id']))
+            else:
+                conn.execute("UPDATE jobs SET status = 'pending', not_before = ? WHERE id = ?", (now + backoffDelay(job['attempts'], backoff), job['id']))
+
+        job = conn.execute("SELECT * FROM jobs WHERE status = 'pending' AND not_before <= ? ORDER BY attempts, id LIMIT 1", (now,)).fetchone()
+        if job != None:
+            conn.execute("UPDATE jobs SET status = 'running', worker = ?, attempts = attempts + 1, lease_expires = ?, heartbeat = ?, started = ?, finished = NULL, returncode = NULL WHERE id = ?",
+                         (worker_id, now + lease, now, now, job['id']))
+            job = conn.execute('SELECT * FROM jobs WHERE id = ?', (job['id'],)).fetchone()
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    return job
+
+
+# Note: renews the lease. Returns False if the job is no longer ours (the lease
+#       ran out and another worker took it over).
+def heartbeat(conn, job_id, worker_id, lease=LEASE_SECONDS):
+    now = time.time()
+    cursor = conn.execute("UPDATE jobs SET lease_expires = ?, heartbeat = ? WHERE id = ? AND worker = ? AND status = 'running'",
+                          (now + lease, now, job_id, worker_id))
+    return cursor.rowcount == 1
+
+
+# Note: records the attempt and moves the job to done, back to pending (with
+#       backoff) or to failed once it ran out of attempts.
+def completeJob(conn, job, worker_id, returncode, log_file=None, message=None, backoff=BACKOFF_SECONDS):
+    now = time.time()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute('INSERT INTO results (job_id, attempt, worker, started, finished, returncode, log_file, message) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                     (job['id'], job['attempts'], worker_id, job['started'], now, returncode, log_file, message))
+        if returncode == 0:
+            status, not_before = 'done', 0
+        elif job['attempts'] >= job['max_attempts']:
+            status, not_before = 'failed', 0
+        else:
+            status, not_before = 'pending', now + backoffDelay(job['attempts'], backoff)
+        conn.execute('UPDATE jobs SET status = ?, not_before = ?, finished = ?, returncode = ? WHERE id = ? AND worker = ? AND status = \'running\'',
+                     (status, not_before, now, returncode, job['id'], worker_id))
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    return status
+
+
+# Note: stops the whole process group of a job: SIGTERM first, then SIGKILL for
+#       whatever is still running after the grace period.
+def stopJob(process, grace=TERMINATE_GRACE_SECONDS):
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        return
+    deadline = time.time() + grace
+    while process.poll() == None and time.time() < deadline:
+        time.sleep(0.1)
+    # children may outlive Pipeline.py, so the group is killed even if it exited
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def runJob(queue_path, job, worker_id, log_dir, lease=LEASE_SECONDS, heartbeat_interval=HEARTBEAT_SECONDS, max_heartbeat_failures=MAX_HEARTBEAT_FAILURES):
+    command = jobCommand(job)
+    log_file = os.path.join(log_dir, 'job{}_{}{}_attempt{}.log'.format(job['id'], job['subject'], '_' + job['session'] if job['session'] != '' else '', job['attempts']))
+
+    with open(log_file, 'w') as log:
+        log.write('# worker: {}\n# command: {}\n'.format(worker_id, ' '.join(shlex.quote(c) for c in command)))
+        log.flush()
+        # own session/process group, so that stopping the job also reaches the nipype
+        # MultiProc workers and FSL/ANTs children and not only Pipeline.py itself
+        process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+
+        # the heartbeat runs on its own connection next to the job
+        stop = threading.Event()
+        lost = threading.Event()
+        # a locked or unreachable queue (e.g. a lock held past the timeout on shared
+        # storage) is retried on the next beat; only several failed beats in a row
+        # count as a lost lease
+        def beat():
+            hb_conn = None
+            failures = 0
+            while not stop.wait(heartbeat_interval):
+                try:
+                    if hb_conn == None:
+                        hb_conn = connectQueue(queue_path)
+                    ours = heartbeat(hb_conn, job['id'], worker_id, lease)
+                    failures = 0
+                except sqlite3.Error as e:
+                    failures += 1
+                    print('Worker {}: heartbeat {} of {} for job {} failed: {}'.format(worker_id, failures, max_heartbeat_failures, job['id'], e))
+                    if hb_conn != None:
+                        hb_conn.close()
+                        hb_conn = None
+                    if failures < max_heartbeat_failures:
+                        continue
+                    ours = False
+                if not ours:
+                    lost.set()
+                    stopJob(process)
+                    break
+            if hb_conn != None:
+                hb_conn.close()
+        beater = threading.Thread(target=beat, daemon=True)
+        beater.start()
+
+        returncode = process.wait()
+        stop.set()
+        beater.join()
+
+    message = None
+    if lost.is_set():
+        message = 'lease lost, job was stopped'
+    return returncode, log_file, message
+
+
+def runWorker(queue_path, worker_id=None, log_dir=None, lease=LEASE_SECONDS, heartbeat_interval=HEARTBEAT_SECONDS, backoff=BACKOFF_SECONDS, poll=POLL_SECONDS, wait=False):
+    if worker_id == None:
+        worker_id = '{}:{}'.format(socket.gethostname(), os.getpid())
+    if log_dir == None:
+        log_dir = os.path.join(os.path.dirname(os.path.abspath(queue_path)), 'logs')
+    os.makedirs(log_dir, exist_ok=True)
+
+    conn = connectQueue(queue_path)
+    numJobs = 0
+    print('Worker {} started on queue {}'.format(worker_id, queue_path))
+    while True:
+        job = claimJob(conn, worker_id, lease, backoff)
+        if job == None:
+            left = conn.execute("SELECT COUNT(*) FROM jobs WHERE status IN ('pending', 'running')").fetchone()[0]
+            if left == 0 and not wait:
+                break
+            time.sleep(poll)
+            continue
+
+        print('Worker {} runs job {} ({} {}), attempt {} of {}'.format(worker_id, job['id'], job['subject'], job['session'], job['attempts'], job['max_attempts']))
+        tic = time.time()
+        try:
+            returncode, log_file, message = runJob(queue_path, job, worker_id, log_dir, lease, heartbeat_interval)
+        except OSError as e:
+            returncode, log_file, message = -1, None, str(e)
+        status = completeJob(conn, job, worker_id, returncode, log_file, message, backoff)
+        toc = time.time()
+        print('Worker {} finished job {} in {:.1f}s: returncode {} -> {}'.format(worker_id, job['id'], toc-tic, returncode, status))
+        numJobs += 1
+
+    conn.close()
+    print('Worker {} is done after {} job(s).'.format(worker_id, numJobs))
+    return numJobs
+
+
+def printStatus(queue_path, listJobs=False):
+    conn = connectQueue(queue_path)
+    for row in conn.execute('SELECT status, COUNT(*) AS n FROM jobs GROUP BY status ORDER BY status'):
+        print('{:>8}: {}'.format(row['status'], row['n']))
+    if listJobs:
+        for job in conn.execute('SELECT * FROM jobs ORDER BY id'):
+            print('{:>5} {:<12} {:<10} {:<8} attempts={}/{} worker={} returncode={}'.format(job['id'], job['subject'], job['session'], job['status'], job['attempts'], job['max_attempts'], job['worker'], job['returncode']))
+    conn.close()
+
+
+def main():
+    parser = makeParser()
+    args   = parser.parse_args()
+
+    if args.mode == 'enqueue':
+        # workers run in another directory (and maybe on another host), so the paths are stored absolute
+        parentDir = os.path.abspath(args.parentDir[0])
+        outDir    = os.path.abspath(args.ourDir[0])
+        max_attempts = int(vetArgNone(args.maxAttempts, MAX_ATTEMPTS))
+        template  = vetArgNone(args.command, None)
+        conn = connectQueue(args.queue[0])
+        added = 0
+        jobs = discoverJobs(parentDir, args.subject_id, vetArgNone(args.index, None), not args.noHash)
+        for subject, session in jobs:
+            if template != None:
+                command = shlex.split(template.format(subject=subject, session=session, parentDir=parentDir, outDir=outDir))
+            else:
+                command = pipelineArgs(parentDir, outDir, subject, session, args.pipeline_args)
+            added += enqueueJob(conn, subject, session, command, max_attempts)
+        conn.close()
+        print('Added {} of {} subject/session job(s) to {}'.format(added, len(jobs), args.queue[0]))
+
+    elif args.mode == 'worker':
+        runWorker(args.queue[0],
+                  worker_id = vetArgNone(args.workerId, None),
+                  log_dir   = vetArgNone(args.logDir, None),
+                  lease     = float(vetArgNone(args.lease, LEASE_SECONDS)),
+                  heartbeat_interval = float(vetArgNone(args.heartbeat, HEARTBEAT_SECONDS)),
+                  backoff   = float(vetArgNone(args.backoff, BACKOFF_SECONDS)),
+                  poll      = float(vetArgNone(args.poll, POLL_SECONDS)),
+                  wait      = args.wait)
+
+    else:
+        printStatus(args.queue[0], args.jobs)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("\n\tReceived Keyboard Interrupt, ending program.\n")
+        sys.exit(2)
@@ -1,34 +1,136 @@
+import gzip
 import nibabel as nib
 import numpy as np
 import os 
+import shutil
 import subprocess
 import nipype.interfaces.fsl as fsl  # fsl
 
 # Note: takes in the paths to the template and bold images and outputs the
 # array of average intensity values for each brain region
-def make_average_arr(bold_path, template_path, maxSegVal):
+def make_average_arr(bold_path, template_path, maxSegVal, dtype='float32'):
     bold = nib.load(bold_path)
     template = nib.load(template_path)
-    bold_array = bold.get_fdata()
-    template_array = template.get_fdata() 
+    bold_array = bold.get_fdata(dtype=dtype)
+    # the labels are read with their on-disk (usually integer) type
+    template_array = np.asanyarray(template.dataobj)
     _,_,_,timepoints = bold.shape
-    structure_indices = maxSegVal+1
-    uniq_structure_indices = np.unique(template_array)
-    avg_arr = np.zeros((int(timepoints),int(structure_indices)))
+    structure_indices = int(maxSegVal)+1
+    # one pass over the voxels per frame: the label of every voxel is used as a bin
+    labels = np.rint(template_array).astype(np.int64).ravel()
+    inRange = (labels >= 0) & (labels < structure_indices)
+    labels = labels[inRange]
+    counts = np.bincount(labels, minlength=structure_indices)
+    avg_arr = np.zeros((int(timepoints),structure_indices))
     for t in range(int(timepoints)):
-        bold_time = bold_array[:,:,:,t]
-        for s in range(int(structure_indices)):
-            if s not in uniq_structure_indices:
-                avg_arr[t,s] = 0. # to avoid finding average of missing indexes (i.e former thalami regions)
-                continue
-            template_indices = template_array == s
-            matrix = bold_time[template_indices]
-            res = np.average(matrix)
-            avg_arr[t,s] = res
+        bold_time = bold_array[:,:,:,t].ravel()[inRange]
+        sums = np.bincount(labels, weights=bold_time, minlength=structure_indices)
+        # missing indexes (i.e former thalami regions) are left at 0
+        np.divide(sums, counts, out=avg_arr[t], where=counts > 0)
     # avg_arr = np.nan_to_num(avg_arr) #redundant but do just incase
     return avg_arr
 
 
+# Note: takes in the paths to the bold image and a brain mask and outputs the
+# time series of every voxel inside the mask (T x voxels) along with the
+# voxel coordinates, for voxelwise graphs
+def make_voxel_arr(bold_path, mask_path, dtype='float32'):
+    bold = nib.load(bold_path)
+    mask = np.asanyarray(nib.load(mask_path).dataobj) > 0
+    bold_array = bold.get_fdata(dtype=dtype)
+    voxel_arr = bold_array[mask].T
+    voxel_coords = np.argwhere(mask)
+    return voxel_arr, voxel_coords
+
+
+# Note: z-scores every column so that the correlation of two columns is their
+# dot product divided by the number of rows. Constant columns (missing regions)
+# become 0 and therefore never produce an edge.
+def standardize_columns(arr, dtype=np.float32):
+    arr = np.asarray(arr, dtype=np.float64)
+    arr = arr - np.mean(arr, axis=0)
+    std = np.sqrt(np.mean(arr ** 2, axis=0))
+    std[std == 0] = np.inf
+    return (arr / std).astype(dtype)
+
+
+# Note: blocked (tile by tile) version of build_sim_arr for fine parcellations and
+# voxelwise graphs. Only one block_size x block_size tile of the correlation
+# matrix exists at a time; edges are kept if |r| >= threshold and/or if they are
+# among the top_k strongest (by |r|) of their row. The result is written as a
+# symmetric scipy CSR matrix (.npz) without self connections, so memory scales
+# with the number of kept edges rather than with nodes squared.
+def build_sparse_sim_arr(ts_arr, out_file, block_size=1024, threshold=None, top_k=None, dtype='float32'):
+    import scipy.sparse as sparse
+
+    if threshold == None and top_k == None:
+        raise ValueError('Either a threshold or top_k is needed to sparsify the similarity matrix.')
+
+    rows, columns = ts_arr.shape
+    z = standardize_columns(ts_arr, dtype)
+    block_size = int(block_size)
+
+    edge_rows, edge_cols, edge_vals = [], [], []
+    for i0 in range(0, columns, block_size):
+        i1 = min(i0 + block_size, columns)
+        if top_k != None:
+            k = int(top_k)
+            best_cols = np.zeros((i1 - i0, 0), dtype=np.int64)
+            best_vals = np.zeros((i1 - i0, 0), dtype=np.float32)
+
+        # with a threshold only, the matrix is symmetric and the lower tiles are skipped
+        j_start = i0 if top_k == None else 0
+        for j0 in range(j_start, columns, block_size):
+            j1 = min(j0 + block_size, columns)
+            tile = z[:, i0:i1].T.dot(z[:, j0:j1]) / rows
+            tile_rows, tile_cols = np.indices(tile.shape)
+            tile_rows += i0
+            tile_cols += j0
+            keep = tile_rows != tile_cols
+            if top_k == None:
+                keep &= tile_cols > tile_rows
+            if threshold != None:
+                keep &= np.abs(tile) >= threshold
+
+            if top_k == None:
+                edge_rows.append(tile_rows[keep])
+                edge_cols.append(tile_cols[keep])
+                edge_vals.append(tile[keep])
+            else:
+                # merge this tile into the running top k of every row
+                cand_vals = np.hstack((best_vals, np.where(keep, tile, 0.)))
+                cand_cols = np.hstack((best_cols, tile_cols))
+                cand_keep = np.hstack((best_vals != 0, keep))
+                score = np.where(cand_keep, np.abs(cand_vals), -1.)
+                if score.shape[1] > k:
+                    idx = np.argpartition(-score, k - 1, axis=1)[:, :k]
+                else:
+                    idx = np.broadcast_to(np.arange(score.shape[1]), score.shape)
+                best_vals = np.take_along_axis(np.where(cand_keep, cand_vals, 0.), idx, axis=1).astype(np.float32)
+                best_cols = np.take_along_axis(cand_cols, idx, axis=1)
+
+        if top_k != None:
+            keep = best_vals != 0
+            edge_rows.append(np.broadcast_to(np.arange(i0, i1)[:, np.newaxis], best_vals.shape)[keep])
+            edge_cols.append(best_cols[keep])
+            edge_vals.append(best_vals[keep])
+
+    edge_rows = np.concatenate(edge_rows) if len(edge_rows) > 0 else np.zeros(0, dtype=np.int64)
+    edge_cols = np.concatenate(edge_cols) if len(edge_cols) > 0 else np.zeros(0, dtype=np.int64)
+    edge_vals = np.concatenate(edge_vals).astype(np.float32) if len(edge_vals) > 0 else np.zeros(0, dtype=np.float32)
+    adjacency = sparse.coo_matrix((edge_vals, (edge_rows, edge_cols)), shape=(columns, columns)).tocsr()
+
+    # make the graph undirected: an edge kept for either of its nodes is kept for both
+    if top_k == None:
+        adjacency = adjacency + adjacency.T
+    else:
+        adjacency = adjacency + adjacency.T - adjacency.multiply(adjacency.T.astype(bool))
+    adjacency = sparse.csr_matrix(adjacency, dtype=np.float32)
+
+    sparse.save_npz(out_file, adjacency)
+    return adjacency.nnz
+
+
 # Note: takes in the average intensity array from the previous function and  
 # calculates the Pearson Correlation Coefficients to find similarity between
 # regions
@@ -52,6 +154,163 @@ def build_sim_arr(avg_arr):
     return sim_matrix
 
 
+# Note: seed to voxel correlation maps for many seeds at once. The seed time series
+#       (the columns of the average array) and the voxel time series are both
+#       z-scored, so the correlation maps are the matrix product
+#       (seeds x T) . (T x voxels) / T, computed in dtype (float32: BLAS sgemm) one slab
+#       of slices at a time. Volume i of the 4D output is the map of seeds[i]; by
+#       default every ROI except the background (0). Missing ROIs give empty maps.
+def build_seed_maps(avg_arr, bold_path, mask_path, out_file, seeds=None, chunk_slices=4, dtype='float32'):
+    timepoints = nib.load(bold_path).shape[-1]
+    if avg_arr.shape[0] != timepoints:
+        raise ValueError('The average array has {} frames but {} has {}.'.format(avg_arr.shape[0], bold_path, timepoints))
+    if seeds == None:
+        seeds = list(range(1, avg_arr.shape[1]))
+
+    # slabs of a .nii.gz can only be read by decompressing the file again for every
+    # slab, so the BOLD is decompressed once next to the output and memory mapped
+    tmp_path = None
+    if bold_path.endswith('.gz'):
+        tmp_path = os.path.join(os.path.dirname(os.path.abspath(out_file)), 'tmp{}_{}'.format(os.getpid(), os.path.basename(bold_path)[:-3]))
+        with gzip.open(bold_path, 'rb') as src, open(tmp_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst, 1<<24)
+        bold_path = tmp_path
+
+    try:
+        bold = nib.load(bold_path, mmap=True)
+        mask = np.asanyarray(nib.load(mask_path).dataobj) > 0
+
+        seed_z = standardize_columns(avg_arr[:, seeds], dtype).T
+        seed_maps = np.zeros(bold.shape[:3] + (len(seeds),), dtype=dtype)
+
+        for z0 in range(0, bold.shape[2], chunk_slices):
+            z1 = min(z0 + chunk_slices, bold.shape[2])
+            slab_mask = mask[:, :, z0:z1]
+            if not np.any(slab_mask):
+                continue
+            slab = np.asarray(bold.dataobj[:, :, z0:z1, :], dtype=dtype)
+            voxel_z = standardize_columns(slab[slab_mask].T, dtype)
+            seed_maps[:, :, z0:z1][slab_mask] = seed_z.dot(voxel_z).T / timepoints
+
+        # fresh header: the 4th axis holds seeds, not frames, so it must not inherit
+        # the BOLD's TR, time units or slice timing
+        seed_img = nib.Nifti1Image(seed_maps, bold.affine)
+        seed_img.set_qform(bold.header.get_qform(), code=int(bold.header['qform_code']))
+        seed_img.set_sform(bold.header.get_sform(), code=int(bold.header['sform_code']))
+        seed_img.header.set_zooms(tuple(bold.header.get_zooms()[:3]) + (1.,))
+        seed_img.header.set_xyzt_units(xyz=bold.header.get_xyzt_units()[0])
+        seed_img.set_data_dtype(dtype)
+        seed_img.header.set_intent('correlation', (timepoints - 2,), name='seed correlation')
+        nib.save(seed_img, out_file)
+    finally:
+        bold = None
+        if tmp_path != None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return seeds
+
+
+# Note: window shapes supported by build_dynamic_sim_arr. Every taper is written as
+#       a + b*cos(2*pi*k/(W-1)) so that it can be slid along the time series
+#       without recomputing the window (see build_dynamic_sim_arr)
+DYNAMIC_TAPERS = {'rectangular': (1.0, 0.0), 'hann': (0.5, -0.5), 'hamming': (0.54, -0.46)}
+
+
+# Note: puts the rows of a censored average array back on the original timeline.
+#       Censored frames become rows of NaN so that windows keep their length in time.
+def uncensor_avg_arr(avg_arr, rejected_frames):
+    rejected_frames = set(int(f) for f in rejected_frames)
+    timepoints = avg_arr.shape[0] + len(rejected_frames)
+    full_arr = np.full((timepoints, avg_arr.shape[1]), np.nan)
+    kept = [t for t in range(timepoints) if t not in rejected_frames]
+    full_arr[kept, :] = avg_arr
+    return full_arr
+
+
+# Note: sliding window (dynamic) version of build_sim_arr. Instead of recomputing
+#       every window from scratch (O(W*S^2) per window) the weighted sums
+#       sum(w*x), sum(w*x*x') and sum(w) are updated as the window slides: the
+#       frames leaving the window are subtracted and the frames entering are added,
+#       so each step costs O(step*S^2). The cosine part of a taper is carried by
+#       complex running sums weighted with exp(i*theta*t); shifting the window by s
+#       frames is then a multiplication by exp(-i*theta*s).
+#       Frames that are censored (NaN rows or listed in censored_frames) get weight 0.
+#       Each window's upper triangle is streamed into a float32 .npy memmap of shape
+#       (windows, S*(S-1)/2) so only one window is ever held in memory.
+def build_dynamic_sim_arr(avg_arr, out_file, window_length, step=1, taper='rectangular', censored_frames=None, min_frames=None, refresh_every=500):
+    timepoints, columns = avg_arr.shape
+    window_length = int(window_length)
+    step = int(step)
+    if taper not in DYNAMIC_TAPERS:
+        raise ValueError('Unknown taper {}. Choose one of {}'.format(taper, list(DYNAMIC_TAPERS.keys())))
+    if min_frames == None:
+        min_frames = max(3, window_length // 2)
+
+    valid = np.all(np.isfinite(avg_arr), axis=1)
+    if censored_frames != None:
+        for frame in censored_frames:
+            valid[int(frame)] = False
+
+    # removing a constant per column does not change the covariance but keeps the
+    # running sums small, which avoids cancellation when they are subtracted
+    data = np.where(valid[:, np.newaxis], avg_arr, 0.)
+    if np.any(valid):
+        data = data - np.mean(data[valid], axis=0)
+        data[~valid] = 0.
+    mask = valid.astype(np.float64)
+
+    a, b = DYNAMIC_TAPERS[taper]
+    theta = 2 * np.pi / max(window_length - 1, 1)
+    phase = np.exp(1j * theta * np.arange(timepoints)) * mask
+
+    numWindows = 0
+    if timepoints >= window_length:
+        numWindows = (timepoints - window_length) // step + 1
+    iu = np.triu_indices(columns, k=1)
+    dyn_arr = np.lib.format.open_memmap(out_file, mode='w+', dtype=np.float32, shape=(numWindows, len(iu[0])))
+
+    def frameSums(frames):
+        x = data[frames]
+        m = mask[frames]
+        p = phase[frames]
+        return [m.sum(), m.dot(x), (x * m[:, np.newaxis]).T.dot(x),
+                p.sum(), p.dot(x), (x * p[:, np.newaxis]).T.dot(x)]
+
+    starts = []
+    numFrames = []
+    sums = None
+    for w in range(numWindows):
+        start = w * step
+        stop  = start + window_length
+        if sums is None or step >= window_length or w % refresh_every == 0:
+            sums = frameSums(slice(start, stop))
+        else:
+            leaving  = frameSums(slice(start - step, start))
+            entering = frameSums(slice(stop - step, stop))
+            sums = [s - l + e for s, l, e in zip(sums, leaving, entering)]
+
+        starts.append(start)
+        numFrames.append(int(np.sum(valid[start:stop])))
+        if numFrames[-1] < min_frames:
+            dyn_arr[w] = np.nan
+            continue
+
+        # weighted sums of the tapered window starting at 'start'
+        shift = np.exp(-1j * theta * start)
+        sw  = a * sums[0] + b * np.real(shift * sums[3])
+        sx  = a * sums[1] + b * np.real(shift * sums[4])
+        sxx = a * sums[2] + b * np.real(shift * sums[5])
+
+        cov = (sxx - np.outer(sx, sx) / sw) / sw
+        std = np.sqrt(np.clip(np.diag(cov), 0., None))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sim_matrix = cov / np.outer(std, std)
+        dyn_arr[w] = sim_matrix[iu]
+
+    dyn_arr.flush()
+    del dyn_arr
+    return starts, numFrames
+
+
 def getVolume(in_file, volumeIndex, outfile = None):
     import os
     import nipype.interfaces.fsl as fsl  # fsl
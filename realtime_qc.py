@@ -0,0 +1,328 @@
+################################################################################
+# Author:  Joy Roy, William Reynolds, Rafael Ceschin
+# Purpose: Incremental (real-time) motion and connectivity QC. Volumes are
+#          consumed one at a time as they appear in a watched directory and
+#          DVARS, FD, ROI means and a running correlation matrix are updated
+#          with a constant amount of work per new frame.
+#
+# Contact: jor115@pitt.edu
+################################################################################
+import argparse
+import nibabel as nib
+import numpy as np
+import os, sys
+import subprocess
+import time
+
+
+DVARS_THRESHOLD = 5.
+FD_THRESHOLD    = 0.5
+FD_HEAD_RADIUS  = 50. # mm, used to convert rotations to displacements (Power et al 2012)
+VOLUME_EXTENSIONS = ('.nii.gz', '.nii')
+
+
+def makeParser():
+    parser = argparse.ArgumentParser(
+                        prog='Sim_Funky_Pipeline_RealTime',
+                        usage='This program computes motion and connectivity metrics while a scan is still acquiring',
+                        epilog='BUG REPORTING: Report bugs to pirc@chp.edu or more directly to Joy Roy at the Childrens Hospital of Pittsburgh.'
+        )
+    subparsers = parser.add_subparsers(dest='mode')
+    subparsers.required = True
+
+    watch = subparsers.add_parser('watch', help='Watches a directory and processes each new 3D volume as it arrives.')
+    watch.add_argument('-w','--watchDir', nargs=1, required=True,
+                        help='Directory in which the scanner (or the drop mode) writes one 3D NIFTI per volume.')
+    watch.add_argument('-o','--outDir', nargs=1, required=True,
+                        help='Directory where the running metrics and matrices are written.')
+    watch.add_argument('-seg','--segment', nargs=1, required=False,
+                        help='Atlas already in the space of the incoming volumes (e.g. the warped atlas of a previous run). Without it no ROI means/correlations are computed.')
+    watch.add_argument('-m','--mask', nargs=1, required=False,
+                        help='Brain mask in the space of the incoming volumes used for DVARS.')
+    watch.add_argument('-nv','--nvols', nargs=1, required=False,
+                        help='Number of volumes expected. The watcher stops once they were all processed.')
+    watch.add_argument('--timeout', nargs=1, required=False,
+                        help='Seconds without a new volume after which the watcher stops. Default is 60.')
+    watch.add_argument('--poll', nargs=1, required=False,
+                        help='Seconds between two looks at the watched directory. Default is 0.1.')
+    watch.add_argument('--saveEvery', nargs=1, required=False,
+                        help='Writes the running similarity matrix every N volumes. Default is 10.')
+    watch.add_argument('--noFD', required=False, action='store_true',
+                        help='Skips the per-volume FLIRT registration (and therefore FD).')
+
+    drop = subparsers.add_parser('drop', help='Stands in for the scanner by writing the volumes of a 4D file into a directory one by one.')
+    drop.add_argument('-i','--in_file', nargs=1, required=True,
+                        help='4D BOLD to be split into volumes.')
+    drop.add_argument('-w','--watchDir', nargs=1, required=True,
+                        help='Directory the volumes are dropped into.')
+    drop.add_argument('--interval', nargs=1, required=False,
+                        help='Seconds between two volumes. Default is the TR in the header.')
+
+    return parser
+
+
+# This was developed instead of using the default parameter in the argparser
+# bc argparser only returns a list or None and you can't do None[0].
+def vetArgNone(variable, default):
+    if variable==None:
+        return default
+    else:
+        return variable[0]
+
+
+# Note: writes a 4D file into a directory one volume at a time. Every volume is
+#       written under a temporary name first and then renamed, so the watcher
+#       never sees a half written file.
+def dropVolumes(in_file, watch_dir, interval=None):
+    img = nib.load(in_file)
+    numFrames = img.shape[-1]
+    if interval == None:
+        interval = float(img.header.get_zooms()[-1])
+
+    os.makedirs(watch_dir, exist_ok=True)
+    for i in range(numFrames):
+        tic  = time.time()
+        data = np.asanyarray(img.dataobj[..., i])
+        vol  = nib.Nifti1Image(data, img.affine)
+        vol.header.set_xyzt_units(*img.header.get_xyzt_units())
+        outfile = os.path.join(watch_dir, 'vol{:04d}.nii.gz'.format(i))
+        tmpfile = os.path.join(watch_dir, '.vol{:04d}.tmp.nii.gz'.format(i))
+        nib.save(vol, tmpfile)
+        os.replace(tmpfile, outfile)
+        print('Dropped volume {} of {}'.format(i+1, numFrames))
+        time.sleep(max(0., interval - (time.time() - tic)))
+
+
+# Note: lists the finished volumes of the watched directory in acquisition order.
+#       Hidden and temporary files (still being written) are skipped.
+def listVolumes(watch_dir):
+    volumes = []
+    for i in os.listdir(watch_dir):
+        if i.startswith('.') or '.tmp' in i:
+            continue
+        if i.endswith(VOLUME_EXTENSIONS):
+            volumes.append(i)
+    return sorted(volumes)
+
+
+# Note: rigid registration of a single volume to the reference volume. Returns
+#       the 6 motion parameters (3 rotations in radians, 3 translations in mm
+#       about the centre of the volume) or None if FLIRT failed.
+def registerVolume(in_file, reference, out_matrix_file):
+    import nipype.interfaces.fsl as fsl  # fsl
+
+    flirt = fsl.FLIRT()
+    flirt.inputs.in_file = in_file
+    flirt.inputs.reference = reference
+    flirt.inputs.dof = 6
+    flirt.inputs.out_matrix_file = out_matrix_file
+    flirt.inputs.out_file = '{}_flirt.nii.gz'.format(os.path.splitext(out_matrix_file)[0])
+
+    cmdline = flirt.cmdline.split(' ')
+    result = subprocess.run(cmdline, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0 or not os.path.exists(out_matrix_file):
+        print(f"Error occurred: {result.stderr}")
+        return None
+    # the registered volume itself is not needed
+    if os.path.exists(flirt.inputs.out_file):
+        os.remove(flirt.inputs.out_file)
+
+    matrix = np.loadtxt(out_matrix_file)
+    img = nib.load(reference)
+    centre = (np.array(img.shape[:3]) - 1) / 2. * np.array(img.header.get_zooms()[:3])
+    return matrixToMotionParameters(matrix, centre)
+
+
+def matrixToMotionParameters(matrix, centre):
+    rotation = matrix[:3, :3]
+    rx = np.arctan2(rotation[2, 1], rotation[2, 2])
+    ry = np.arcsin(np.clip(-rotation[2, 0], -1., 1.))
+    rz = np.arctan2(rotation[1, 0], rotation[0, 0])
+    # FLIRT rotates about the corner of the volume, move the translation to the centre
+    translation = rotation.dot(centre) + matrix[:3, 3] - centre
+    return np.array([rx, ry, rz, translation[0], translation[1], translation[2]])
+
+
+# Note: keeps the running state of the scan. Every call to addFrame costs the same
+#       no matter how many frames came before it: DVARS only needs the previous
+#       frame, FD the previous motion parameters, and the ROI correlation matrix is
+#       kept as a running mean/co-moment (Welford) so it never revisits old frames.
+class IncrementalConnectivity:
+
+    def __init__(self, atlas_path=None, mask_path=None):
+        self.numFrames = 0
+        self.previous  = None
+        self.scale     = None
+        self.previousParams = None
+        self.mask = None
+        if mask_path != None:
+            self.mask = np.asanyarray(nib.load(mask_path).dataobj) > 0
+
+        self.labels = None
+        if atlas_path != None:
+            labels = np.asanyarray(nib.load(atlas_path).dataobj)
+            self.labels = np.rint(labels).astype(np.int64).ravel()
+            self.numROIs = int(self.labels.max()) + 1
+            self.counts  = np.bincount(self.labels, minlength=self.numROIs)
+            self.mean    = np.zeros(self.numROIs)
+            self.comoment = np.zeros((self.numROIs, self.numROIs))
+
+    def addFrame(self, data, motion_params=None):
+        data = np.asarray(data, dtype=np.float32)
+
+        # DVARS_THRESHOLD belongs to median 1000 normalized data (see median_1000_normalization
+        # in Pipeline.py). The whole run is not known yet, so the scale is taken from the
+        # median (inside the mask) of the first frame and applied to every frame.
+        if self.scale is None:
+            median = np.median(data[self.mask] if self.mask is not None else data)
+            if median <= 0:
+                median = np.median(data[data > 0]) if np.any(data > 0) else 1.
+            self.scale = np.float32(1000. / median)
+        data = data * self.scale
+        if self.mask is not None:
+            data = np.where(self.mask, data, 0.)
+
+        # DVARS of the first frame is 0 like in MO_DVARS_Subprocess
+        dvars = 0.
+        if self.previous is not None:
+            dvars = float(np.sqrt(np.mean((data - self.previous) ** 2)))
+        self.previous = data
+
+        fd = 0.
+        if motion_params is not None:
+            if self.previousParams is not None:
+                delta = np.abs(motion_params - self.previousParams)
+                fd = float(FD_HEAD_RADIUS * np.sum(delta[:3]) + np.sum(delta[3:]))
+            self.previousParams = motion_params
+
+        roi_means = None
+        if self.labels is not None:
+            sums = np.bincount(self.labels, weights=data.ravel(), minlength=self.numROIs)
+            roi_means = np.zeros(self.numROIs)
+            np.divide(sums, self.counts, out=roi_means, where=self.counts > 0)
+
+            # Welford update of the mean and co-moment matrix
+            delta = roi_means - self.mean
+            self.mean += delta / (self.numFrames + 1)
+            self.comoment += np.outer(delta, roi_means - self.mean)
+
+        self.numFrames += 1
+        return dvars, fd, roi_means
+
+    def covariance(self):
+        if self.numFrames < 2:
+            return np.full(self.comoment.shape, np.nan)
+        return self.comoment / (self.numFrames - 1)
+
+    def correlation(self):
+        cov = self.covariance()
+        std = np.sqrt(np.diag(cov))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sim_matrix = cov / np.outer(std, std)
+        # no self connections, same as build_sim_arr
+        np.fill_diagonal(sim_matrix, 0.)
+        return sim_matrix
+
+
+def watchDirectory(watch_dir, out_dir, atlas_path=None, mask_path=None, nvols=None, timeout=60., poll=0.1, save_every=10, register=True):
+    os.makedirs(out_dir, exist_ok=True)
+    state = IncrementalConnectivity(atlas_path, mask_path)
+
+    metrics_path  = os.path.join(out_dir, 'realtime_metrics.tsv')
+    avg_arr_path  = os.path.join(out_dir, 'average_arr.csv')
+    sim_matrix_path = os.path.join(out_dir, 'sim_matrix.csv')
+    matrix_dir    = os.path.join(out_dir, 'flirt_matrices')
+    if register:
+        os.makedirs(matrix_dir, exist_ok=True)
+
+    metrics = open(metrics_path, 'w')
+    metrics.write('frame\tvolume\tdvars\tdvars_outlier\tfd\tfd_outlier\tprocessing_s\tlatency_s\n')
+    avg_arr = open(avg_arr_path, 'w') if state.labels is not None else None
+
+    processed = set()
+    reference = None
+    lastArrival = time.time()
+    print('Watching {} for new volumes...'.format(watch_dir))
+    try:
+        while True:
+            if nvols != None and state.numFrames >= nvols:
+                break
+            new_volumes = [v for v in listVolumes(watch_dir) if v not in processed]
+            if nvols != None:
+                new_volumes = new_volumes[:nvols - state.numFrames]
+            if len(new_volumes) == 0:
+                if time.time() - lastArrival > timeout:
+                    print('No new volume for {}s, stopping.'.format(timeout))
+                    break
+                time.sleep(poll)
+                continue
+
+            lastArrival = time.time()
+            for volume in new_volumes:
+                volume_path = os.path.join(watch_dir, volume)
+                tic = time.time()
+
+                params = None
+                if register:
+                    if reference == None:
+                        reference = volume_path
+                        params = np.zeros(6)
+                    else:
+                        out_matrix = os.path.join(matrix_dir, '{}.mat'.format(volume.split('.')[0]))
+                        params = registerVolume(volume_path, reference, out_matrix)
+
+                data = nib.load(volume_path).get_fdata(dtype=np.float32)
+                dvars, fd, roi_means = state.addFrame(data, params)
+
+                toc = time.time()
+                latency = toc - os.path.getmtime(volume_path)
+                metrics.write('{}\t{}\t{}\t{}\t{}\t{}\t{:.4f}\t{:.4f}\n'.format(state.numFrames-1, volume, dvars, int(dvars > DVARS_THRESHOLD), fd, int(fd > FD_THRESHOLD), toc-tic, latency))
+                metrics.flush()
+                if avg_arr is not None:
+                    avg_arr.write(','.join(repr(float(x)) for x in roi_means) + '\n')
+                    avg_arr.flush()
+                print('Volume {} ({}): DVARS={:.3f} FD={:.3f} latency={:.3f}s'.format(state.numFrames-1, volume, dvars, fd, latency))
+
+                if state.labels is not None and state.numFrames % save_every == 0:
+                    np.savetxt(sim_matrix_path, state.correlation(), delimiter=",")
+
+                processed.add(volume)
+    finally:
+        metrics.close()
+        if avg_arr is not None:
+            avg_arr.close()
+        if state.labels is not None and state.numFrames > 0:
+            np.savetxt(sim_matrix_path, state.correlation(), delimiter=",")
+
+    return metrics_path
+
+
+def main():
+    parser = makeParser()
+    args   = parser.parse_args()
+
+    if args.mode == 'drop':
+        interval = vetArgNone(args.interval, None)
+        if interval != None:
+            interval = float(interval)
+        dropVolumes(args.in_file[0], args.watchDir[0], interval)
+    else:
+        nvols = vetArgNone(args.nvols, None)
+        if nvols != None:
+            nvols = int(nvols)
+        watchDirectory(args.watchDir[0], args.outDir[0],
+                       atlas_path = vetArgNone(args.segment, None),
+                       mask_path  = vetArgNone(args.mask, None),
+                       nvols      = nvols,
+                       timeout    = float(vetArgNone(args.timeout, 60.)),
+                       poll       = float(vetArgNone(args.poll, 0.1)),
+                       save_every = int(vetArgNone(args.saveEvery, 10)),
+                       register   = not args.noFD)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("\n\tReceived Keyboard Interrupt, ending program.\n")
+        sys.exit(2)
@@ -12,6 +12,16 @@ case "$1" in
     terminal)
         bash  
     ;;
+
+    realtime)
+        shift
+        eval python3 /app/realtime_qc.py "$@"
+    ;;
+
+    queue)
+        shift
+        eval python3 /app/job_queue.py "$@"
+    ;;
     
     *)
         eval python3 /app/Pipeline.py "$@"